@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+import tempfile
+import random
+import time
+import sys
+import os
+
+import pyarrow.parquet as pq
+import pyarrow.csv as pcsv
+import pyarrow as pa
+
+import stubs
+
+# Time writing ROWS pp_forms_log rows in every export format, reading each file back, and the size
+# of each file.
+#
+#   python benchmarks/export_formats.py
+#
+# Rows come from a cursor stand-in returning prebuilt tuples, so only write_batches is measured,
+# not MySQL. Each format runs with the flag computed in MySQL and with client-side detection,
+# where the cursor returns form documents of FORM_BYTES bytes instead. Every file is read back
+# with pyarrow, which stands in for the decoding COPY does, and has to hold the same rows. Plain
+# CSV is what INTO OUTFILE S3 writes without the client.
+
+ROWS = int(os.getenv('ROWS', 1000000))
+FORM_BYTES = int(os.getenv('FORM_BYTES', 2000))
+FORMATS = ['csv', 'csv.gz', 'csv.zst', 'parquet']
+
+# -------------------------------------- Functions --------------------------------------
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+
+    def fetchmany(self, size):
+        batch = self.rows[self.position:self.position + size]
+        self.position += len(batch)
+        return batch
+
+
+def make_rows(rng, detect):
+    forms = []
+    for marker in ['', '"purchaseProtection": {"enabled": true}', '"PurchaseProtection": {"enabled": false}']:
+        body = '{"fields": [' + ', '.join(f'{{"name": "field{i}"}}' for i in range(FORM_BYTES // 20)) + ']'
+        forms.append((body[:FORM_BYTES] + ('' if not marker else ', ' + marker) + '}', 1 if marker else 0))
+    start = datetime(2020, 1, 1)
+    rows = []
+    for i in range(ROWS):
+        form, flag = forms[0] if rng.random() < 0.7 else rng.choice(forms[1:])
+        rows.append((i + 1, rng.randint(1, 1000000), form if detect else flag, start + timedelta(seconds=i * 37)))
+    return rows
+
+
+def read_back(path, fmt, schema):
+    if fmt == 'parquet':
+        return pq.read_table(path)
+    with pa.input_stream(path, compression='detect') as f:
+        return pcsv.read_csv(f, convert_options=pcsv.ConvertOptions(column_types=dict(zip(schema.names, schema.types))))
+
+
+def main():
+    stubs.install()
+    import purchase_protection_log as pp
+
+    print(f"{ROWS} rows, {pp.FETCH_ROWS} per batch")
+    print(f"{'format':<10} {'detection':<10} {'write':>8} {'read':>8} {'MiB':>8} {'vs csv':>7}")
+    expected = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for detect in [False, True]:
+            rows = make_rows(random.Random(0), detect)
+            sizes = {}
+            for fmt in FORMATS:
+                path = os.path.join(tmp, f'export.{fmt}')
+                started = time.monotonic()
+                pp.write_batches(FakeCursor(rows), path, fmt, detect)
+                seconds = time.monotonic() - started
+                sizes[fmt] = os.path.getsize(path)
+
+                started = time.monotonic()
+                table = read_back(path, fmt, pp.SCHEMA)
+                read = time.monotonic() - started
+                print(f"{fmt:<10} {'python' if detect else 'sql':<10} {seconds:>8.2f} {read:>8.2f} "
+                      f"{sizes[fmt] / 1024 ** 2:>8.1f} {sizes[fmt] / sizes['csv']:>7.2f}")
+                flags = table.column('pp_enabled')
+                if expected is None:
+                    expected = flags
+                if table.num_rows != ROWS or not flags.equals(expected):
+                    sys.exit(f'The {fmt} export does not hold the rows written.')
+
+
+if __name__ == '__main__':
+    main()
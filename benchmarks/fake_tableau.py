@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+import responses
+import random
+import re
+
+# Fake Tableau REST API serving a generated site, so tableau_refreshes.py can run unmodified
+# through tableauserverclient. Every request is answered by the responses library and counted.
+
+API_VERSION = '3.19'
+PROJECTS = ['Data-team', 'Financial Dashboards', 'Marketing', 'Purchase Protect', 'Sandbox']
+
+# Datasources named like extracts the audit checks permissions for, so missing groups are reported
+AUDITED = [('Cohort Account Retention New', 'Financial Dashboards'), ('PP Orders New', 'Purchase Protect'),
+           ('Attach Rate', 'Purchase Protect'), ('Invoices', 'Data-team'), ('Account Conversions', 'Marketing')]
+NS = 'xmlns="http://tableau.com/api"'
+
+
+def tsresponse(body, pagination=''):
+    return f'<?xml version="1.0" encoding="UTF-8"?><tsResponse {NS}>{pagination}{body}</tsResponse>'
+
+
+# Generated site: datasources spread over the projects, tasks refreshing them at random hours
+# and every datasource granted to a few groups.
+class Site:
+    def __init__(self, datasources=500, tasks=500, groups=50, seed=0):
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+        self.groups = {f'group-{i}': f'Group {i}' for i in range(groups)}
+        self.groups.update({'group-de': 'Data Engineering', 'group-internal': 'Internal'})
+        self.datasources = {}
+        for i in range(datasources):
+            ds_id = f'ds-{i}'
+            name, project = AUDITED[i] if i < len(AUDITED) else (f'Datasource {i}', PROJECTS[i % len(PROJECTS)])
+            self.datasources[ds_id] = {
+                'name': name,
+                'project': project,
+                'updated_at': (now - timedelta(days=rng.choice([0, 0, 0, 1, 3]), hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'groups': ['group-de', 'group-internal'] + rng.sample(sorted(self.groups)[:groups], 2)
+            }
+        ids = sorted(self.datasources)
+        self.tasks = [{'id': f'task-{i}', 'target': ids[i % len(ids)], 'start': f'{rng.choice([1, 2, 2, 2, 5]):02d}:30:00'}
+                      for i in range(tasks)]
+
+    def datasource_xml(self, ds_id):
+        ds = self.datasources[ds_id]
+        return (f'<datasource id="{ds_id}" name="{ds["name"]}" hasExtracts="true" type="hyper" '
+                f'updatedAt="{ds["updated_at"]}" createdAt="2020-01-01T00:00:00Z">'
+                f'<project id="p-{ds["project"]}" name="{ds["project"]}"/><owner id="owner"/></datasource>')
+
+    def task_xml(self, task):
+        return (f'<task><extractRefresh id="{task["id"]}" priority="50" consecutiveFailedCount="0" type="RefreshExtractTask">'
+                f'<schedule frequency="Daily" nextRunAt="2030-01-01T00:00:00Z"><frequencyDetails start="{task["start"]}">'
+                f'<intervals><interval hours="24"/></intervals></frequencyDetails></schedule>'
+                f'<datasource id="{task["target"]}"/></extractRefresh></task>')
+
+    def permissions_xml(self, ds_id):
+        rules = ''.join(f'<granteeCapabilities><group id="{g}"/><capabilities><capability name="Read" mode="Allow"/>'
+                        f'</capabilities></granteeCapabilities>' for g in self.datasources[ds_id]['groups'])
+        return f'<permissions><datasource id="{ds_id}"/>{rules}</permissions>'
+
+
+def page(items, query, tag):
+    size = int(query.get('pageSize', ['100'])[0])
+    number = int(query.get('pageNumber', ['1'])[0])
+    chunk = items[(number - 1) * size:number * size]
+    pagination = f'<pagination pageNumber="{number}" pageSize="{size}" totalAvailable="{len(items)}"/>'
+    return tsresponse(f'<{tag}>{"".join(chunk)}</{tag}>', pagination)
+
+
+# Function to answer a request against the site
+def handle(site, request):
+    url = urlparse(request.url)
+    path = re.sub(r'^/api/[\d.]+', '', re.sub('/+', '/', url.path))
+    query = parse_qs(url.query)
+
+    if path == '/serverInfo':
+        body = tsresponse(f'<serverInfo><productVersion build="0">2024.2</productVersion>'
+                          f'<restApiVersion>{API_VERSION}</restApiVersion></serverInfo>')
+    elif path == '/auth/signin':
+        body = tsresponse('<credentials token="stub-token"><site id="site" contentUrl="webconnex"/><user id="user"/></credentials>')
+    elif path == '/auth/signout':
+        return 204, {}, ''
+    elif path == '/sites/site/datasources':
+        body = page([site.datasource_xml(i) for i in site.datasources], query, 'datasources')
+    elif m := re.fullmatch(r'/sites/site/datasources/([^/]+)/permissions', path):
+        body = tsresponse(site.permissions_xml(m.group(1)))
+    elif m := re.fullmatch(r'/sites/site/datasources/([^/]+)', path):
+        body = tsresponse(site.datasource_xml(m.group(1)))
+    elif path == '/sites/site/groups':
+        body = page([f'<group id="{k}" name="{v}"/>' for k, v in site.groups.items()], query, 'groups')
+    elif path == '/sites/site/tasks/extractRefreshes':
+        body = tsresponse(f'<tasks>{"".join(site.task_xml(t) for t in site.tasks)}</tasks>')
+    elif path == '/sites/site/workbooks':
+        body = page([], query, 'workbooks')
+    else:
+        return 404, {}, tsresponse(f'<error code="404000"><summary>Not found</summary><detail>{path}</detail></error>')
+    return 200, {'Content-Type': 'application/xml'}, body
+
+
+# Function to answer the requests to Tableau Online hosts made through mock with the site
+def register(mock, site):
+    for method in (responses.GET, responses.POST):
+        mock.add_callback(method, re.compile(r'https://[^/]*tableau\.com/.*'), callback=lambda request: handle(site, request))
+
+
+# Function to start serving the site; returns the responses mock, whose calls list holds every request
+def serve(site):
+    mock = responses.RequestsMock(assert_all_requests_are_fired=False)
+    register(mock, site)
+    mock.start()
+    return mock
@@ -0,0 +1,214 @@
+from urllib.parse import urlparse
+import tempfile
+import sqlite3
+import json
+import csv
+import io
+import re
+import os
+
+import pyarrow as pa
+import pandas as pd
+import duckdb
+import boto3
+
+# Local stand-ins for Redshift (DuckDB) and the Aurora MySQL source (SQLite), so the jobs can run
+# unmodified. Only the statements the jobs send are supported. S3 is whatever boto3 points to,
+# e.g. a moto server set through AWS_ENDPOINT_URL, and COPY and INTO OUTFILE S3 read and write it.
+# DuckDB runs every statement in its own transaction, so commit and rollback do nothing.
+
+PART_ROWS = int(os.getenv('PART_ROWS', 100000))  # rows per part written by INTO OUTFILE S3
+
+COPY = re.compile(r"^\s*COPY\s+(\S+)\s+FROM\s+'s3://([^/]+)/([^']+)'(.*)$", re.I | re.S)
+OUTFILE = re.compile(r"^(.*)INTO OUTFILE S3 's3://([^/]+)/([^']+)'.*$", re.I | re.S)
+CREATE_LIKE = re.compile(r'CREATE TEMP TABLE (\S+) \(LIKE (\S+)\)', re.I)
+
+# information_schema.columns with the data type names Redshift reports
+COLUMNS_VIEW = """
+create view main.rs_columns as
+select table_schema, table_name, column_name,
+    case
+        when data_type like 'DECIMAL%' then 'numeric'
+        when data_type = 'VARCHAR' then 'character varying'
+        when data_type = 'DOUBLE' then 'double precision'
+        else lower(data_type)
+    end as data_type
+from information_schema.columns
+"""
+
+# -------------------------------------- Functions --------------------------------------
+
+def s3_client():
+    return boto3.client('s3', region_name=os.getenv('AWS_DEFAULT_REGION', 'us-west-2'))
+
+
+# Function to return the S3 objects a COPY reads: the entries of a manifest, or every object under a prefix
+def copy_sources(bucket, key, manifest):
+    client = s3_client()
+    if manifest:
+        entries = json.loads(client.get_object(Bucket=bucket, Key=key)['Body'].read())['entries']
+        return [(urlparse(e['url']).netloc, urlparse(e['url']).path.lstrip('/')) for e in entries]
+    pages = client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key)
+    return [(bucket, o['Key']) for page in pages for o in page.get('Contents', [])]
+
+
+# A Redshift warehouse: one DuckDB database shared by every connection to it
+class Warehouse:
+    def __init__(self):
+        self.db = duckdb.connect()
+        for schema in ('wbx_data', 'wbx_data_dbt'):
+            self.db.execute(f'create schema {schema}')
+        self.db.execute("create macro getdate() as current_timestamp::timestamp")
+        self.db.execute(COLUMNS_VIEW)
+
+    def connect(self, *args):
+        return Redshift(self.db.cursor())
+
+    def query(self, sql):
+        return self.db.cursor().execute(sql).fetchall()
+
+
+# A redshift_connector connection. Its cursors share one DuckDB connection, so temporary tables
+# are visible to all of them like in a Redshift session.
+class Redshift:
+    def __init__(self, con):
+        self.con = con
+
+    def cursor(self):
+        return RedshiftCursor(self.con)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    # Function to write a DataFrame to schema.table, standing in for awswrangler's redshift.copy
+    def load_frame(self, df, schema, table, mode):
+        exists = self.con.execute(f"select count(*) from information_schema.tables where table_schema = '{schema}' "
+                                  f"and table_name = '{table}'").fetchone()[0]
+        self.con.register('frame', pa.Table.from_pandas(df, preserve_index=False))
+        try:
+            if exists and mode == 'overwrite':
+                self.con.execute(f'delete from {schema}.{table}')
+            if exists:
+                self.con.execute(f'insert into {schema}.{table} by name select * from frame')
+            else:
+                self.con.execute(f'create table {schema}.{table} as select * from frame')
+        finally:
+            self.con.unregister('frame')
+
+
+class RedshiftCursor:
+    def __init__(self, con):
+        self.con = con
+        self.description = None
+
+    def execute(self, sql, *args):
+        if re.match(r'\s*grant\b', sql, re.I):
+            self.description = None
+            return self
+        copy = COPY.match(sql)
+        if copy:
+            self.copy(*copy.groups())
+            return self
+        sql = CREATE_LIKE.sub(r'CREATE TEMP TABLE \1 AS SELECT * FROM \2 LIMIT 0', sql)
+        sql = re.sub(r'information_schema\.columns', 'main.rs_columns', sql, flags=re.I)
+        self.con.execute(sql, *args)
+        self.description = self.con.description
+        return self
+
+    def copy(self, table, bucket, key, options):
+        client = s3_client()
+        header = 1 if 'IGNOREHEADER 1' in options.upper() else 0
+        compression = 'gzip' if 'GZIP' in options.upper() else 'zstd' if 'ZSTD' in options.upper() else 'none'
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, (b, k) in enumerate(copy_sources(bucket, key, 'MANIFEST' in options.upper())):
+                path = os.path.join(tmp, str(i))
+                client.download_file(b, k, path)
+                if 'PARQUET' in options.upper():
+                    self.con.execute(f"insert into {table} select * from read_parquet('{path}')")
+                else:
+                    self.con.execute(f"insert into {table} select * from read_csv('{path}', header = {bool(header)}, "
+                                     f"all_varchar = true, compression = '{compression}')")
+        self.description = None
+
+    def fetchall(self):
+        return self.con.fetchall()
+
+    def fetchone(self):
+        return self.con.fetchone()
+
+    def fetchmany(self, size):
+        return self.con.fetchmany(size)
+
+    def close(self):
+        pass
+
+
+# Stand-ins for awswrangler.redshift.copy and copy_from_files. The frame or the Parquet files
+# are written straight to the warehouse instead of being staged in S3 and copied.
+def wr_copy(df, path, con, table, schema, mode='append', **kwargs):
+    con.load_frame(df, schema, table, mode)
+
+
+def wr_copy_from_files(path, con, table, schema, mode='append', manifest=False, **kwargs):
+    url = urlparse(path)
+    client = s3_client()
+    frames = [pd.read_parquet(io.BytesIO(client.get_object(Bucket=b, Key=k)['Body'].read()))
+              for b, k in copy_sources(url.netloc, url.path.lstrip('/'), manifest)]
+    con.load_frame(pd.concat(frames, ignore_index=True), schema, table, mode)
+
+
+# The MySQL source: a SQLite file, so forked export workers can open their own connections
+class MySQL:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+
+    def cursor(self, cursor_class=None):
+        return MySQLCursor(self.db.cursor())
+
+    def close(self):
+        self.db.close()
+
+
+class MySQLCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rowcount = -1
+
+    # INTO OUTFILE S3 writes the result as CSV parts of PART_ROWS rows with a header, like Aurora
+    def execute(self, sql, *args):
+        outfile = OUTFILE.match(sql)
+        if not outfile:
+            self.cursor.execute(sql, *args)
+            return
+        query, bucket, key = outfile.groups()
+        self.cursor.execute(query)
+        header = [d[0] for d in self.cursor.description]
+        client = s3_client()
+        self.rowcount = 0
+        part = 0
+        while True:
+            rows = self.cursor.fetchmany(PART_ROWS)
+            if not rows:
+                break
+            f = io.StringIO()
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows(rows)
+            client.put_object(Bucket=bucket, Key=f'{key}.part_{part:05d}', Body=f.getvalue().encode())
+            self.rowcount += len(rows)
+            part += 1
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def close(self):
+        self.cursor.close()
@@ -0,0 +1,104 @@
+import random
+import time
+import sys
+import os
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+import stubs
+
+# Compare the exchange rate join of processing_retention_aux before and after exchange_rates_daily,
+# in DuckDB, on TRANSACTIONS transactions and rates for CURRENCIES currencies with MISSING_DAYS of
+# the days missing.
+#
+#   python benchmarks/fx_join.py   (needs duckdb)
+#
+# "before" joins exchange_rates on the truncated transaction date, "after" joins exchange_rates_daily
+# on day_key. Both queries are the join of the model with the aggregation over it. Where exchange_rates
+# has a rate, both joins have to find the same one; the days it misses only match after.
+# DuckDB hash-joins both the same way, so this measures the key computation and the missing days;
+# on Redshift the daily table also avoids redistribution (diststyle ALL) and is sorted on the key.
+
+TRANSACTIONS = int(os.getenv('TRANSACTIONS', 2000000))
+CURRENCIES = int(os.getenv('CURRENCIES', 30))
+MISSING_DAYS = float(os.getenv('MISSING_DAYS', 0.03))
+REPEAT = int(os.getenv('REPEAT', 3))
+
+JOINS = {
+    'before': """
+        select count(*) as rows, count(er.rate) as matched, sum(t.amount * er.rate) as total
+        from dim_transaction as t
+        left join exchange_rates as er
+            on t.currency = er.currency
+            and date_trunc('day', t.date_created)::date = er.date""",
+    'after': """
+        select count(*) as rows, count(er.rate) as matched, sum(t.amount * er.rate) as total
+        from dim_transaction as t
+        left join exchange_rates_daily as er
+            on t.currency = er.currency
+            and datediff('day', '1970-01-01', t.date_created) = er.day_key"""
+}
+
+# -------------------------------------- Functions --------------------------------------
+
+def load(con, rng):
+    import exchange_rates
+    currencies = [f'C{i:02d}' for i in range(CURRENCIES)]
+    days = pd.date_range('2015-01-01', pd.Timestamp.now().normalize(), freq='D')
+    rates = pd.DataFrame([(d.date(), c, round(rng.uniform(0.5, 2), 6))
+                          for d in days for c in currencies if rng.random() >= MISSING_DAYS],
+                         columns=['date', 'currency', 'rate'])
+    gen = np.random.default_rng(rng.randint(0, 2 ** 32))
+    start = np.datetime64('2016-01-01', 's').astype(np.int64)
+    transactions = pd.DataFrame({
+        'amount': np.round(gen.uniform(5, 500, TRANSACTIONS), 2),
+        'currency': np.array(currencies)[gen.integers(0, CURRENCIES, TRANSACTIONS)],
+        'date_created': gen.integers(start, int(time.time()) - 86400, TRANSACTIONS).astype('datetime64[s]')
+    })
+    daily = exchange_rates.build_rate_matrix(rates)
+
+    for name, df in [('exchange_rates', rates), ('exchange_rates_daily', daily), ('dim_transaction', transactions)]:
+        con.register('df', df)
+        con.execute(f'create table {name} as select * from df')
+        con.unregister('df')
+    con.execute('alter table dim_transaction alter amount type decimal(18, 2)')
+    return len(rates), len(daily)
+
+
+def timed(con, sql):
+    best = None
+    for _ in range(REPEAT):
+        started = time.monotonic()
+        result = con.execute(sql).fetchone()
+        elapsed = time.monotonic() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    stubs.install()
+    con = duckdb.connect()
+    rates, daily = load(con, random.Random(0))
+    print(f"{TRANSACTIONS} transactions, {rates} rates, {daily} daily rates")
+
+    for name, sql in JOINS.items():
+        seconds, (rows, matched, _) = timed(con, sql)
+        print(f"{name:<8} {seconds:>7.3f}s  {matched}/{rows} transactions with a rate")
+
+    # The daily table must hold the same rate as exchange_rates on every day that has one
+    differing = con.execute("""
+        select count(*)
+        from dim_transaction as t
+        join exchange_rates as er
+            on t.currency = er.currency and date_trunc('day', t.date_created)::date = er.date
+        join exchange_rates_daily as d
+            on t.currency = d.currency and datediff('day', '1970-01-01', t.date_created) = d.day_key
+        where er.rate <> d.rate""").fetchone()[0]
+    if differing:
+        sys.exit(f'{differing} transactions get a different rate from exchange_rates_daily.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+from datetime import date, timedelta
+from io import BytesIO
+import random
+import time
+import sys
+import os
+
+from openpyxl import Workbook, load_workbook
+from moto import mock_aws
+import pandas as pd
+import boto3
+
+import stubs
+
+# Time downloading and parsing WORKBOOKS manual transaction workbooks from a local (moto) S3
+# bucket, before and after the parallel, streaming parser.
+#
+#   python benchmarks/parse_files.py
+#
+# "before" is the sequential download and parse loop of manual_transactions.py at the first commit.
+# "after" is parse_files with each number of workers in WORKERS. moto answers in-process,
+# so S3_LATENCY seconds are added to every download to stand in for the round trip to S3.
+
+WORKBOOKS = int(os.getenv('WORKBOOKS', 200))
+SHEETS = int(os.getenv('SHEETS', 2))
+ROWS = int(os.getenv('ROWS', 500))  # rows per sheet
+S3_LATENCY = float(os.getenv('S3_LATENCY', 0.05))
+WORKERS = [int(w) for w in os.getenv('WORKERS', f'1,{max(4, os.cpu_count() or 1)}').split(',')]
+BUCKET = 'wbx-data.redshift-unload'
+PREFIX = 'raw/manual_transactions/'
+
+# -------------------------------------- Functions --------------------------------------
+
+def workbook_bytes(rng, columns):
+    workbook = Workbook(write_only=True)
+    for _ in range(SHEETS):
+        sheet = workbook.create_sheet()
+        sheet.append(columns + ['Notes'])
+        for _ in range(ROWS):
+            sheet.append([date(2024, 1, 1) + timedelta(days=rng.randint(0, 600)), rng.randint(1000, 99999),
+                          rng.choice(['donations', 'tickets']), round(rng.uniform(-50, 5000), 2), 'Manual', 'x'])
+    f = BytesIO()
+    workbook.save(f)
+    return f.getvalue()
+
+
+# The loop of manual_transactions.py at the first commit, without the column conversions
+def parse_before(s3, files):
+    all_dfs = []
+    for file in files:
+        time.sleep(S3_LATENCY)
+        body = s3.Object(BUCKET, file).get()['Body'].read()
+        workbook = load_workbook(BytesIO(body))
+        dfs = []
+        for s in workbook.sheetnames:
+            df = pd.DataFrame(workbook[s].values)
+            df.columns = df.iloc[0]
+            df = df[1:].reset_index(drop=True).dropna(how='all')
+            dfs.append(df[['Date', 'Account ID', 'Product', 'Amount', 'Source - Tableau (additional item)']])
+        all_dfs.append(pd.concat(dfs, ignore_index=True))
+    return all_dfs
+
+
+def timed(fn, *args):
+    started = time.monotonic()
+    result = fn(*args)
+    return time.monotonic() - started, result
+
+
+def main():
+    stubs.install()
+    import manual_transactions as mt
+
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-west-2')
+        client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+        rng = random.Random(0)
+        files = [f'{PREFIX}{i:04d}.xlsx' for i in range(WORKBOOKS)]
+        for key in files:
+            client.put_object(Bucket=BUCKET, Key=key, Body=workbook_bytes(rng, mt.COLUMNS))
+
+        mt.logger = stubs.get_logger()
+        mt.bucket_name = BUCKET
+        mt.s3_client = client
+        download = mt.download_file
+
+        def download_file(key):
+            time.sleep(S3_LATENCY)
+            return download(key)
+        mt.download_file = download_file
+
+        print(f"{WORKBOOKS} workbooks of {SHEETS} x {ROWS} rows, {S3_LATENCY * 1000:.0f}ms per download")
+        seconds, before = timed(parse_before, boto3.resource('s3', region_name='us-west-2'), files)
+        print(f"{'before':<17} {seconds:>7.2f}s")
+
+        results = []
+        for workers in WORKERS:
+            mt.MAX_WORKERS = workers
+            seconds, after = timed(mt.parse_files, files)
+            results.append(after)
+            print(f"{f'after, {workers} workers':<17} {seconds:>7.2f}s")
+
+    rows = sum(len(df) for df in before)
+    if any(sum(len(df) for df in r) != rows for r in results):
+        sys.exit('parse_files returned a different number of rows than the baseline loop.')
+    if any(not a.equals(b) for a, b in zip(results[0], results[-1])):
+        sys.exit('parse_files returned different frames with more workers.')
+
+
+if __name__ == '__main__':
+    main()
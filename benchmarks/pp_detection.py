@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+import tempfile
+import random
+import time
+import sys
+import os
+
+import pyarrow.csv as pcsv
+
+import stubs
+import fake_warehouse
+
+# Time exporting ROWS published_version rows with the purchase protection flag computed by the
+# LIKE scan in the database and by the client, against the SQLite stand-in for MySQL.
+#
+#   python benchmarks/pp_detection.py
+#
+# Forms are JSON documents of FORM_BYTES bytes, PP_SHARE of them holding the marker at a random
+# place. Both runs execute select_query on the same rows and stream them with write_batches into
+# a CSV file, like an export through the client; only the flag differs. "sql" sends the LIKE to
+# the database and receives a flag per row, "python" receives the forms and matches them in
+# batches. Both files have to hold the same flags. SQLite's LIKE stands in for MySQL's, so this
+# compares the two paths on one machine rather than predicting the Aurora timings.
+
+ROWS = int(os.getenv('ROWS', 20000))
+FORM_BYTES = int(os.getenv('FORM_BYTES', 10000))
+PP_SHARE = float(os.getenv('PP_SHARE', 0.3))
+REPEAT = int(os.getenv('REPEAT', 3))
+
+# -------------------------------------- Functions --------------------------------------
+
+def make_form(rng, pp):
+    fields = [f'{{"name": "field{i}", "type": "text"}}' for i in range(FORM_BYTES // 34)]
+    if pp:
+        fields.insert(rng.randint(0, len(fields)), rng.choice(['{"purchaseProtection": {"enabled": true}}',
+                                                               '{"PurchaseProtection": {"enabled": false}}']))
+    return '{"fields": [' + ', '.join(fields) + ']}'
+
+
+def seed(path, rng):
+    mysql = fake_warehouse.MySQL(path)
+    mysql.db.execute('create table published_version (id integer primary key, form_id integer, form text, '
+                     'date_created timestamp, date_updated timestamp)')
+    plain, pp = make_form(rng, False), [make_form(rng, True) for _ in range(20)]
+    start = datetime(2020, 1, 1)
+    mysql.db.executemany('insert into published_version values (?, ?, ?, ?, ?)',
+                         [(i, rng.randint(1, 100000), rng.choice(pp) if rng.random() < PP_SHARE else plain,
+                           start + timedelta(minutes=i), start + timedelta(minutes=i)) for i in range(1, ROWS + 1)])
+    mysql.db.commit()
+    return mysql
+
+
+# Function to run the export of every row with the given detection. Returns the best seconds
+# over REPEAT runs and the flags written.
+def export(pp, mysql, path, detect):
+    best = None
+    for _ in range(REPEAT):
+        started = time.monotonic()
+        cursor = mysql.cursor()
+        cursor.execute(pp.select_query('id > 0', detect))
+        pp.write_batches(cursor, path, 'csv', detect)
+        elapsed = time.monotonic() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, pcsv.read_csv(path).column('pp_enabled')
+
+
+def main():
+    stubs.install()
+    import purchase_protection_log as pp
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mysql = seed(os.path.join(tmp, 'published_version.db'), random.Random(0))
+        print(f"{ROWS} forms of {FORM_BYTES} bytes, {PP_SHARE:.0%} with purchase protection")
+        flags = {}
+        for name, detect in [('sql', False), ('python', True)]:
+            seconds, flags[name] = export(pp, mysql, os.path.join(tmp, f'{name}.csv'), detect)
+            print(f"{name:<8} {seconds:>8.2f}s {ROWS / seconds:>10.0f} rows/s")
+        mysql.close()
+
+    if not flags['sql'].equals(flags['python']):
+        sys.exit('Client-side detection flagged different forms than LIKE.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+from datetime import date, timedelta
+import random
+import time
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+
+import stubs
+
+# Time accumulating DATES API responses of CURRENCIES rates each, before and after the columnar
+# buffer.
+#
+#   python benchmarks/rate_buffer.py
+#
+# "before" builds a frame per response and concatenates it to the running frame, like the loop of
+# exchange_rates.py at the first commit. "after" appends to RateBuffer and builds one frame at the
+# end. Both have to return the same rows. The cost per date is also shown for each WINDOW dates:
+# it grows with the frame already built when concatenating and stays flat with the buffer.
+
+DATES = int(os.getenv('DATES', 3650))      # ten years of daily responses
+CURRENCIES = int(os.getenv('CURRENCIES', 170))
+WINDOW = int(os.getenv('WINDOW', 500))     # dates per window of the cost per date
+
+# -------------------------------------- Functions --------------------------------------
+
+def responses(rng):
+    currencies = [f'C{i:03d}' for i in range(CURRENCIES)]
+    start = date(2015, 1, 1)
+    return [(str(start + timedelta(days=i)), {c: rng.uniform(0.1, 1000) for c in currencies}) for i in range(DATES)]
+
+
+# Function to yield the responses and add the seconds spent on each WINDOW of them to windows
+def windowed(data, windows):
+    started = time.monotonic()
+    for i, response in enumerate(data, 1):
+        yield response
+        if i % WINDOW == 0 or i == len(data):
+            windows.append(time.monotonic() - started)
+            started = time.monotonic()
+
+
+def before(data, windows):
+    exchange_rates = pd.DataFrame()
+    for day, rates in windowed(data, windows):
+        rates = pd.DataFrame(list(rates.items()), columns=['currency', 'rate'])
+        rates['date'] = day
+        rates['rate'] = 1 / rates['rate']
+        rates = rates[['date', 'currency', 'rate']]
+        exchange_rates = pd.concat([exchange_rates, rates], ignore_index=True)
+    return exchange_rates
+
+
+def after(data, windows):
+    import exchange_rates
+    buffer = exchange_rates.RateBuffer()
+    for day, rates in windowed(data, windows):
+        buffer.append(day, rates)
+    return buffer.to_frame()
+
+
+def timed(fn, data):
+    windows = []
+    started = time.monotonic()
+    result = fn(data, windows)
+    return time.monotonic() - started, windows, result
+
+
+def main():
+    stubs.install()
+    import exchange_rates  # noqa: F401, imported before timing
+    data = responses(random.Random(0))
+    print(f"{DATES} responses of {CURRENCIES} rates")
+
+    results, windows = {}, {}
+    for name, fn in [('before', before), ('after', after)]:
+        seconds, windows[name], results[name] = timed(fn, data)
+        print(f"{name:<8} {seconds:>8.2f}s")
+
+    print(f"\n{'dates':<12} {'before':>10} {'after':>10}   ms per date")
+    for i, (old, new) in enumerate(zip(windows['before'], windows['after'])):
+        size = min(WINDOW, DATES - i * WINDOW)
+        dates = f"{i * WINDOW + 1}-{i * WINDOW + size}"
+        print(f"{dates:<12} {old / size * 1000:>10.3f} {new / size * 1000:>10.3f}")
+
+    old, new = results['before'], results['after']
+    same = (len(old) == len(new)
+            and (pd.to_datetime(old['date']).values == pd.to_datetime(new['date']).values).all()
+            and (old['currency'].values == new['currency'].values).all()
+            and np.array_equal(old['rate'].values, new['rate'].values))
+    if not same:
+        sys.exit('RateBuffer returned different rows than the concatenated frames.')
+
+
+if __name__ == '__main__':
+    main()
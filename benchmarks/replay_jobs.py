@@ -0,0 +1,265 @@
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+from io import BytesIO
+import warnings
+import tempfile
+import logging
+import random
+import json
+import time
+import sys
+import io
+import re
+import os
+
+from moto.server import ThreadedMotoServer
+from openpyxl import Workbook
+import responses
+import boto3
+
+import stubs
+import fake_tableau
+import fake_warehouse
+
+# Replay every job of run_jobs.py locally: S3 is a moto server, Redshift a DuckDB database, the
+# MySQL source a SQLite file and the Tableau and exchange rate APIs are answered by responses.
+#
+#   python benchmarks/replay_jobs.py   (needs duckdb, moto[server] and responses)
+#
+# The jobs run twice through run_jobs.main, as they would in production: a cold run against an
+# empty warehouse, then a warm run after new workbooks, forms and form edits were added to the
+# sources. Each run prints the status, time, top level spans and counters every job wrote to its
+# metrics, and the warehouse has to hold what the sources hold afterwards. Job settings such as
+# PP_EXPORT_FORMAT or PP_DETECTION are read from the environment like in production.
+
+DAYS = int(os.getenv('DAYS', 365))            # days of exchange rates before today
+CURRENCIES = int(os.getenv('CURRENCIES', 20))
+WORKBOOKS = int(os.getenv('WORKBOOKS', 6))    # workbooks per manual transactions table
+ROWS = int(os.getenv('ROWS', 200))            # rows per workbook
+FORMS = int(os.getenv('FORMS', 5000))         # rows of published_version
+BUCKET = 'wbx-data.redshift-unload'
+API_URL = 'https://fx.invalid/api'
+
+# -------------------------------------- Functions --------------------------------------
+
+def start_s3():
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    os.environ['AWS_ENDPOINT_URL'] = f'http://{host}:{port}'
+    return server
+
+
+# Function to point the jobs at throwaway state and the fake APIs. Settings read at import.
+def configure(tmp):
+    os.environ.update({
+        'METRICS_DIR': os.path.join(tmp, 'metrics'),
+        'FX_STATE_FILE': os.path.join(tmp, 'exchange_rates_state.json'),
+        'FX_CACHE_DIR': os.path.join(tmp, 'exchange_rates_cache'),
+        'TABLEAU_SNAPSHOT_DB': os.path.join(tmp, 'tableau_audit.db'),
+        'FX_API_URL': API_URL
+    })
+    for name, value in {'FX_RATE_LIMIT': '1000', 'PP_CHUNK_SIZE': str(max(1, FORMS // 5)), 'PP_RETRY_BACKOFF': '0',
+                        'PP_INCREMENTAL_MODE': 'cdc'}.items():
+        os.environ.setdefault(name, value)
+
+
+def workbook_bytes(rng, columns):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(columns + ['Notes'])
+    for _ in range(ROWS):
+        sheet.append([date(2024, 1, 1) + timedelta(days=rng.randint(0, 600)), rng.randint(1000, 99999),
+                      rng.choice(['donations', 'tickets']), round(rng.uniform(-50, 5000), 2), 'Manual', 'x'])
+    f = BytesIO()
+    workbook.save(f)
+    return f.getvalue()
+
+
+def put_workbook(client, rng, key, columns):
+    client.put_object(Bucket=BUCKET, Key=key, Body=workbook_bytes(rng, columns))
+
+
+def seed_workbooks(client, rng, columns):
+    client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+    for table in ('manual_transactions', 'manual_transactions_pp'):
+        for i in range(WORKBOOKS):
+            put_workbook(client, rng, f'raw/{table}/{i:04d}.xlsx', columns)
+        put_workbook(client, rng, f"raw/{table}/O'Brien.xlsx", columns)
+
+
+def form(rng, pp):
+    marker = rng.choice(['"purchaseProtection": {"enabled": true}', '"PurchaseProtection": {}']) if pp else '"other": 1'
+    return '{"fields": [{"name": "amount"}], ' + marker + '}'
+
+
+# Function to add forms with one id each, updated a second apart up to now
+def add_forms(mysql, rng, ids):
+    now = datetime.now().replace(microsecond=0)
+    mysql.db.executemany('insert into published_version values (?, ?, ?, ?, ?)',
+                         [(i, rng.randint(1, 1000), form(rng, rng.random() < 0.3), now - timedelta(days=1),
+                           now - timedelta(seconds=len(ids) - n)) for n, i in enumerate(ids, 1)])
+    mysql.db.commit()
+
+
+def seed_forms(mysql, rng):
+    mysql.db.execute('create table published_version (id integer primary key, form_id integer, form text, '
+                     'date_created timestamp, date_updated timestamp)')
+    # Sparse ids, like a table with deleted rows
+    add_forms(mysql, rng, range(1, 2 * FORMS, 2))
+
+
+def seed_dates(warehouse):
+    warehouse.query(f"""
+    create table wbx_data_dbt.dim_dates as
+    select range::date as full_date
+    from range(current_date - {DAYS}, current_date + 31, interval 1 day)
+    """)
+
+
+# Function to add new workbooks and forms, replace a workbook with a quote in its name, remove one
+# and edit some forms
+# between the cold and the warm run
+def change_sources(client, mysql, rng, columns):
+    put_workbook(client, rng, "raw/manual_transactions/O'Brien.xlsx", columns)
+    put_workbook(client, rng, f'raw/manual_transactions/{WORKBOOKS:04d}.xlsx', columns)
+    client.delete_object(Bucket=BUCKET, Key='raw/manual_transactions/0001.xlsx')
+
+    last = mysql.db.execute('select max(id) from published_version').fetchone()[0]
+    add_forms(mysql, rng, range(last + 1, last + 1 + FORMS // 50))
+    later = datetime.now().replace(microsecond=0) + timedelta(seconds=1)
+    edited = [(form(rng, i % 2 == 0), later, i) for i in rng.sample(range(1, 2 * FORMS, 2), FORMS // 100)]
+    mysql.db.executemany('update published_version set form = ?, date_updated = ? where id = ?', edited)
+    mysql.db.commit()
+
+
+# Function to answer the exchange rate API with rates derived from the date
+def fx_rates(request):
+    day = re.search(r'/historical/([\d-]+)\.json', request.url).group(1)
+    rng = random.Random(day)
+    rates = {f'C{i:02d}': round(rng.uniform(0.5, 2), 6) for i in range(CURRENCIES)}
+    return 200, {'Content-Type': 'application/json'}, json.dumps({'rates': rates})
+
+
+def serve_apis(site):
+    mock = responses.RequestsMock(assert_all_requests_are_fired=False)
+    mock.add_callback(responses.GET, re.compile(re.escape(API_URL) + r'/historical/.*'), callback=fx_rates)
+    fake_tableau.register(mock, site)
+    mock.start()
+    return mock
+
+
+# Function to run every job through run_jobs.py. Each run starts with an empty resources cache,
+# like a new process. Returns whether run_jobs succeeded.
+def run(name):
+    import run_jobs
+    import resources
+    resources.cache.clear()
+    stubs.reset()
+    started = time.monotonic()
+    try:
+        with redirect_stdout(io.StringIO()):
+            run_jobs.main(list(run_jobs.JOBS))
+        ok = True
+    except SystemExit:
+        ok = False
+    print(f"\n{name} run: {'ok' if ok else 'failed'} in {time.monotonic() - started:.1f}s")
+    print(f"{'job':<24} {'status':<10} {'seconds':>8}")
+    for job in run_jobs.JOBS:
+        path = os.path.join(os.environ['METRICS_DIR'], job, 'latest.json')
+        with open(path) as f:
+            metrics = json.load(f)
+        spans = ', '.join(f"{p} {s['seconds']:.2f}s" for p, s in metrics['spans'].items() if '/' not in p)
+        counters = ', '.join(f'{k} {v}' for k, v in sorted(metrics['counters'].items()))
+        print(f"{job:<24} {metrics['status']:<10} {metrics['seconds']:>8.2f}")
+        print(f"{'':<4}spans: {spans}")
+        print(f"{'':<4}counters: {counters}")
+    return ok
+
+
+# Function to compare the warehouse with the sources. Returns the mismatches found.
+def check(warehouse, mysql, client, site_alerts):
+    errors = []
+
+    expected = warehouse.query('select count(*) from wbx_data_dbt.dim_dates where full_date <= current_date')[0][0]
+    rates, days = warehouse.query('select count(*), count(distinct date) from wbx_data.exchange_rates')[0]
+    if (rates, days) != (expected * CURRENCIES, expected):
+        errors.append(f'exchange_rates has {rates} rates for {days} days, expected {expected} days of {CURRENCIES}.')
+    daily = warehouse.query('select count(*) from wbx_data.exchange_rates_daily where not is_filled')[0][0]
+    if daily != rates:
+        errors.append(f'exchange_rates_daily has {daily} unfilled rows, exchange_rates {rates}.')
+
+    for table in ('manual_transactions', 'manual_transactions_pp'):
+        pages = client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET, Prefix=f'raw/{table}/')
+        files = sorted(o['Key'] for page in pages for o in page.get('Contents', []) if o['Key'].endswith('.xlsx'))
+        loaded = warehouse.query(f'select source_file, count(*) from wbx_data.{table} group by 1 order by 1')
+        if loaded != [(f, ROWS) for f in files]:
+            errors.append(f'{table} does not hold {ROWS} rows for each of the {len(files)} workbooks.')
+
+    forms = mysql.db.execute("""
+    select id, form_id, case when form like '%purchaseProtection%' then 1 else 0 end
+    from published_version order by id""").fetchall()
+    logged = warehouse.query('select id, form_id, pp_enabled from wbx_data.pp_forms_log order by id')
+    if logged != forms:
+        errors.append(f'pp_forms_log has {len(logged)} rows not matching the {len(forms)} published forms.')
+
+    if site_alerts and not any(m.startswith(':warning: Tableau extracts missing permissions') for m in stubs.slack):
+        errors.append('The Tableau audit did not report the missing permissions of the site.')
+    return errors
+
+
+# Function to start the fake services, seed the sources and install the stubs. Returns the
+# warehouse, the MySQL source, the S3 client, the random generator and a function stopping the fakes.
+def setup():
+    # pandas warns about every DBAPI connection but SQLAlchemy's; redshift_connector gets it too
+    warnings.filterwarnings('ignore', 'pandas only supports SQLAlchemy')
+    tmp = tempfile.mkdtemp()
+    server = start_s3()
+    configure(tmp)
+    warehouse = fake_warehouse.Warehouse()
+    mysql_path = os.path.join(tmp, 'published_version.db')
+    stubs.install(get_rs_conn=lambda secret: warehouse.connect(),
+                  get_mysql_client=lambda session, creds: fake_warehouse.MySQL(mysql_path))
+
+    import awswrangler
+    awswrangler.redshift.copy = fake_warehouse.wr_copy
+    awswrangler.redshift.copy_from_files = fake_warehouse.wr_copy_from_files
+    import manual_transactions
+
+    rng = random.Random(0)
+    client = boto3.client('s3', region_name='us-west-2')
+    mysql = fake_warehouse.MySQL(mysql_path)
+    seed_workbooks(client, rng, manual_transactions.COLUMNS)
+    seed_forms(mysql, rng)
+    seed_dates(warehouse)
+    mock = serve_apis(fake_tableau.Site(200, 200))
+
+    def stop():
+        mock.stop()
+        server.stop()
+    return warehouse, mysql, client, rng, stop
+
+
+def main():
+    warehouse, mysql, client, rng, stop = setup()
+    import manual_transactions
+
+    print(f"{DAYS} days of {CURRENCIES} rates, {WORKBOOKS} workbooks of {ROWS} rows per table, {FORMS} forms")
+    errors = []
+    try:
+        for name, site_alerts in [('cold', True), ('warm', False)]:
+            if name == 'warm':
+                change_sources(client, mysql, rng, manual_transactions.COLUMNS)
+            if not run(name):
+                errors.append(f'A job failed in the {name} run.')
+            errors += [f'{name}: {e}' for e in check(warehouse, mysql, client, site_alerts)]
+    finally:
+        stop()
+
+    if errors:
+        sys.exit('\n'.join(errors))
+
+
+if __name__ == '__main__':
+    main()
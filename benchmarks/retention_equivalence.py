@@ -0,0 +1,259 @@
+from datetime import date, timedelta
+import subprocess
+import random
+import time
+import sys
+import re
+import os
+
+import duckdb
+import jinja2
+import pandas as pd
+
+import stubs
+
+# Run the processing_retention models as of BASELINE and as of the working tree on the same
+# synthetic history in DuckDB, and check that they return the same rows.
+#
+#   python benchmarks/retention_equivalence.py   (needs duckdb and jinja2)
+#
+# The window-function rewrite of processing_retention_aux.sql relies on two assumptions, which are
+# checked on the rewritten output before the comparison:
+#   - the months of every account/product/gateway are contiguous, so ROWS frames count months;
+#   - scaling by row_count reproduces the sums the self-joins took over duplicate base rows.
+# Duplicate base rows come from accounts with two account managers, so the history includes some.
+# The history has pauses shorter and longer than a year, refunds and net negative months, and
+# take rates missing for some months. Exchange rates are given for every day, so the forward fill
+# of exchange_rates_daily does not change any rate and both models see the same ones.
+# Both models run as full refreshes. Redshift functions the models use are defined as macros.
+
+ACCOUNTS = int(os.getenv('ACCOUNTS', 120))
+SEED = int(os.getenv('SEED', 0))
+BASELINE = os.getenv('BASELINE') or subprocess.check_output(
+    ['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=stubs.REPO, text=True).split()[0]
+TODAY = date(2026, 6, 15)  # GETDATE() of both runs
+FIRST_MONTH = date(2019, 1, 1)
+PRODUCTS = ['donations', 'tickets', 'registrations', 'memberships']
+GATEWAYS = {1: 'wepay', 2: 'stripe', 3: 'stripe', 4: 'adyen', 5: 'paypal'}
+CURRENCIES = {'USD': 1.0, 'CAD': 1.35, 'EUR': 0.92, 'GBP': 0.79}
+MODELS = ['processing_retention_aux', 'processing_retention']
+
+MACROS = [
+    f"create macro getdate() as timestamp '{TODAY} 00:00:00'",
+    """create macro dateadd(part, n, d) as case part
+        when 'day' then d + to_days(n) when 'month' then d + to_months(n) when 'year' then d + to_years(n) end"""
+]
+
+# Rewrites of Redshift syntax DuckDB does not take, with the model each one has to apply to.
+# account_dates adds up its key columns into an id; DuckDB cannot add text, so the id is built by
+# concatenation, which is just as unique.
+REWRITES = [
+    (r'\b(DATEDIFF|DATE_PART)\((MONTH|YEAR|DAY),', lambda m: f"{m.group(1)}('{m.group(2).lower()}',", None),
+    (r'(\w+)\.account_id \+ \1\.product \+ \1\.gateway_group \+ (\w+)\.date',
+     r"concat_ws('|', \1.account_id, \1.product, \1.gateway_group, \2.date)", 'processing_retention_aux')
+]
+
+# -------------------------------------- Functions --------------------------------------
+
+def month_add(d, months):
+    m = d.year * 12 + d.month - 1 + months
+    return date(m // 12, m % 12 + 1, 1)
+
+
+# Function to generate the source tables of the models
+def synthetic_history(rng):
+    last_month = TODAY.replace(day=1)
+    forms = pd.DataFrame({'id': range(1, 41), 'product': [rng.choice(PRODUCTS) for _ in range(40)]})
+    accounts = pd.DataFrame({'id': range(1, ACCOUNTS + 1), 'name': [f'Account {i}' for i in range(1, ACCOUNTS + 1)],
+                             'organization_id': [rng.choice([1, 1, 1, 2, 3, 4]) for _ in range(ACCOUNTS)]})
+    managers = pd.DataFrame({'id': range(1, 7), 'first_name': [f'First{i}' for i in range(1, 7)],
+                             'last_name': [f'Last{i}' for i in range(1, 7)]})
+    account_managers = [(a, m) for a in accounts['id']
+                        for m in rng.sample(range(1, 7), rng.choice([0, 1, 1, 1, 2]))]
+
+    transactions = []
+    for account in accounts['id']:
+        currency = rng.choice(list(CURRENCIES))
+        for _ in range(rng.choice([1, 1, 2, 3])):
+            form, gateway = rng.randint(1, 40), rng.choice(list(GATEWAYS))
+            month = month_add(FIRST_MONTH, rng.randint(0, 80))
+            while month <= last_month:
+                if rng.random() < 0.15:
+                    # Pause for a few months or for more than a year
+                    month = month_add(month, rng.choice([2, 5, 13, 30]))
+                    continue
+                for _ in range(rng.randint(1, 4)):
+                    created = month + timedelta(days=rng.randint(0, 27), seconds=rng.randint(0, 86399))
+                    kind = 2 if rng.random() < 0.12 else 1
+                    amount = round(rng.uniform(5, 900 if kind == 1 else 1500), 2)
+                    status = 6 if rng.random() < 0.95 else 3
+                    transactions.append((account, form, gateway, status, kind, amount, currency, created))
+                month = month_add(month, 1)
+    transactions = pd.DataFrame(transactions, columns=['account_id', 'form_id', 'gateway_id', 'status', 'transaction_type',
+                                                       'amount', 'currency', 'date_created'])
+
+    days = pd.date_range(month_add(FIRST_MONTH, -1), month_add(TODAY, 1), freq='D')
+    exchange_rates = pd.DataFrame([(d.date(), c, round(r * (1 + 0.05 * rng.uniform(-1, 1)), 6))
+                                   for d in days for c, r in CURRENCIES.items()], columns=['date', 'currency', 'rate'])
+
+    take_rates = [(g, m, p, round(rng.uniform(0.001, 0.006), 6))
+                  for g in ['WePay', 'Stripe', 'Adyen', 'Other'] for p in PRODUCTS
+                  for m in (month_add(FIRST_MONTH, i) for i in range(90)) if rng.random() < 0.8]
+
+    return {
+        'dim_transaction': transactions,
+        'dim_account': accounts,
+        'dim_form': forms,
+        'dim_gateway': pd.DataFrame({'id': list(GATEWAYS), 'type': list(GATEWAYS.values())}),
+        'dim_account_managers': managers,
+        'dim_account_managers_account': pd.DataFrame(account_managers, columns=['account_id', 'account_manager_id']),
+        'dim_dates': pd.DataFrame({'full_date': pd.date_range('2018-01-01', '2029-12-31', freq='D')}),
+        'exchange_rates': exchange_rates,
+        'take_rates': pd.DataFrame(take_rates, columns=['gateway_group', 'date', 'product', 'rate']),
+        'account_attribution_pivot': pd.DataFrame({'account_id': accounts['id'],
+                                                   'utm_medium': [rng.choice([None, 'cpc', 'email']) for _ in range(ACCOUNTS)],
+                                                   'utm_source': [rng.choice([None, 'fb', 'Instagram', 'google']) for _ in range(ACCOUNTS)]}),
+        'industries_master': pd.DataFrame({'account_id': accounts['id'],
+                                           'industry': [rng.choice(['Education', 'Religion', 'Sports']) for _ in range(ACCOUNTS)]}),
+        'processing_volume_retention': pd.DataFrame([(a, p, y, rng.choice(['5. Small ($25k - $100k)', '7. Micro ($1 - $10k)']))
+                                                     for a in accounts['id'] for p in PRODUCTS for y in range(2019, 2027)],
+                                                    columns=['account_id', 'product', 'year', 'customer_size_py']),
+        'max_ttm': pd.DataFrame([(a, p, '7. Micro ($1 - $10k)') for a in accounts['id'] for p in PRODUCTS],
+                                columns=['account_id', 'product', 'product_max_ttm_size'])
+    }
+
+
+# Function to load the history, with the column types the models see in Redshift
+def load_history(con, tables):
+    import exchange_rates  # the daily table is built the way the job builds it
+    for name, df in tables.items():
+        con.register('df', df)
+        con.execute(f'create table {name} as select * from df')
+        con.unregister('df')
+    con.execute('alter table dim_transaction alter amount type decimal(18, 2)')
+    con.execute('alter table dim_transaction alter date_created type timestamp')
+    con.execute('alter table exchange_rates alter rate type decimal(18, 6)')
+    con.execute('alter table take_rates alter rate type decimal(18, 6)')
+    con.execute("alter table dim_dates add column month_day_number integer")
+    con.execute("update dim_dates set month_day_number = day(full_date)")
+
+    daily = exchange_rates.build_rate_matrix(tables['exchange_rates'])
+    con.register('df', daily)
+    con.execute('create table exchange_rates_daily as select * replace (rate::decimal(18, 6) as rate) from df')
+    con.unregister('df')
+
+
+# Function to render a model the way dbt would for a full refresh, reading its refs from tables
+def render(model, sql, refs):
+    sql = re.sub(r'\A\S+\.sql\n', '', sql)  # file name left at the top of the aux model
+    sql = jinja2.Environment().from_string(sql).render(
+        config=lambda **kwargs: '',
+        is_incremental=lambda: False,
+        ref=lambda name: refs.get(name, name),
+        source=lambda schema, name: name,
+        var=lambda name, default=None: default
+    )
+    for pattern, replacement, required in REWRITES:
+        sql, n = re.subn(pattern, replacement, sql)
+        if model == required and n == 0:
+            sys.exit(f'Rewrite {pattern!r} does not apply to {model} any more.')
+    return sql
+
+
+def model_sql(rev, model):
+    if rev is None:
+        with open(os.path.join(stubs.REPO, f'{model}.sql')) as f:
+            return f.read()
+    return subprocess.check_output(['git', 'show', f'{rev}:{model}.sql'], cwd=stubs.REPO, text=True)
+
+
+# Function to build both models of a revision into <prefix>_<model> tables. Returns seconds per model.
+def build(con, rev, prefix):
+    seconds = {}
+    refs = {}
+    for model in MODELS:
+        sql = render(model, model_sql(rev, model), refs)
+        started = time.monotonic()
+        con.execute(f'create table {prefix}_{model} as {sql}')
+        seconds[model] = time.monotonic() - started
+        refs[model] = f'{prefix}_{model}'
+    return seconds
+
+
+def scalar(con, sql):
+    return con.execute(sql).fetchone()[0]
+
+
+# Function to check the assumptions of the rewrite on its output. Returns the number of
+# account/product/gateway months with duplicate rows.
+def check_assumptions(con, aux):
+    gaps = scalar(con, f"""
+        select count(*) from (
+            select account_id, product, gateway_group, count(distinct date) as months,
+                datediff('month', min(date), max(date)) + 1 as span
+            from {aux}
+            group by 1, 2, 3
+        ) where months <> span""")
+    if gaps:
+        sys.exit(f'{gaps} account/product/gateway combinations have gaps in their months.')
+
+    # Every row of a month carries row_count times the rounded total of the rows 12 months before
+    duplicated, mismatched = con.execute(f"""
+        with months as (
+            select account_id, product, gateway_group, date, count(*) as row_count,
+                sum(monthly_total::decimal(15, 3)) as total_rounded,
+                min(monthly_trailing_total) as trailing_min, max(monthly_trailing_total) as trailing_max
+            from {aux}
+            group by 1, 2, 3, 4
+        )
+        select
+            count(*) filter (where m.row_count > 1),
+            count(*) filter (where m.trailing_min <> m.trailing_max
+                or m.trailing_min <> m.row_count * coalesce(p.total_rounded, 0))
+        from months as m
+        left join months as p
+            on m.account_id = p.account_id and m.product = p.product and m.gateway_group = p.gateway_group
+            and p.date = m.date - interval 12 month""").fetchone()
+    if mismatched:
+        sys.exit(f'{mismatched} months have a trailing total that is not row_count times the one 12 months before.')
+    if not duplicated:
+        sys.exit('The history has no duplicate base rows, so row_count scaling is not exercised.')
+    return duplicated
+
+
+# Function to compare the output of both revisions, ignoring the refreshed_at column the
+# incremental models added. Returns the number of rows.
+def compare(con, old, new):
+    columns = ', '.join(c for c, in con.execute(f"select column_name from information_schema.columns "
+                                                 f"where table_name = '{old}' order by ordinal_position").fetchall())
+    rows = scalar(con, f'select count(*) from {old}')
+    for a, b in [(old, new), (new, old)]:
+        extra = scalar(con, f'select count(*) from (select {columns} from {a} except all select {columns} from {b})')
+        if extra:
+            sys.exit(f'{extra} rows of {a} are not in {b}.')
+    if scalar(con, f'select count(*) from {new}') != rows:
+        sys.exit(f'{old} and {new} have different row counts.')
+    return rows
+
+
+def main():
+    stubs.install()
+    con = duckdb.connect()
+    for macro in MACROS:
+        con.execute(macro)
+    tables = synthetic_history(random.Random(SEED))
+    load_history(con, tables)
+    print(f"{ACCOUNTS} accounts, {len(tables['dim_transaction'])} transactions, baseline {BASELINE[:7]}")
+
+    before = build(con, BASELINE, 'old')
+    after = build(con, None, 'new')
+    duplicated = check_assumptions(con, 'new_processing_retention_aux')
+    print(f"months contiguous, row_count scaling holds ({duplicated} months with duplicate rows)")
+
+    for model in MODELS:
+        rows = compare(con, f'old_{model}', f'new_{model}')
+        print(f"{model:<26} {rows:>7} identical rows {before[model]:>8.2f}s before {after[model]:>8.2f}s after")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from contextlib import redirect_stdout
+import subprocess
+import time
+import json
+import sys
+import io
+import os
+
+import stubs
+import replay_jobs
+
+# Compare the startup of the nightly jobs run as separate scripts with one run_jobs.py process
+# sharing the session/secret cache, against the fakes of replay_jobs.py.
+#
+#   python benchmarks/startup.py   (needs duckdb, moto[server] and responses)
+#
+# Imports: every job script loaded pandas, awswrangler or tableauserverclient in its own
+# interpreter, so "separate" is the sum of importing each job module in a fresh interpreter and
+# "runner" importing all of them in one. Nightly run: after a cold run fills the warehouse, the
+# jobs run REPEAT times each way with nothing new in the sources, so startup dominates. "separate"
+# runs one job per run_jobs.main call with an empty cache, like one process per job; "runner"
+# runs them all in one call; the fastest run of each is shown. Startup is the time in the session,
+# secrets and connect spans. Secrets Manager and session calls are counted in this process; forked
+# export workers inherit the cached session in both cases.
+
+REPEAT = int(os.getenv('REPEAT', 3))
+STARTUP_SPANS = ['session', 'secrets', 'connect']
+
+# -------------------------------------- Functions --------------------------------------
+
+# Function to return the best time of REPEAT fresh interpreters importing modules
+def import_seconds(modules):
+    code = (f"import sys, time; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); "
+            f"import stubs; stubs.install(); started = time.perf_counter(); "
+            f"import {', '.join(modules)}; print(time.perf_counter() - started)")
+    return min(float(subprocess.check_output([sys.executable, '-c', code], cwd=stubs.REPO, text=True))
+               for _ in range(REPEAT))
+
+
+def startup_seconds(job):
+    with open(os.path.join(os.environ['METRICS_DIR'], job, 'latest.json')) as f:
+        spans = json.load(f)['spans']
+    return sum(spans.get(s, {}).get('seconds', 0) for s in STARTUP_SPANS)
+
+
+# Function to run the jobs as batches of run_jobs.main calls, each with an empty cache. Returns the
+# wall time, the startup time and the calls made to the utils helpers.
+def nightly(batches):
+    import run_jobs
+    import resources
+    stubs.reset()
+    started = time.monotonic()
+    startup = 0
+    for jobs in batches:
+        resources.cache.clear()
+        with redirect_stdout(io.StringIO()):
+            run_jobs.main(jobs)
+        startup += sum(startup_seconds(j) for j in jobs)
+    return time.monotonic() - started, startup, dict(stubs.calls)
+
+
+def main():
+    stop = replay_jobs.setup()[-1]
+    import run_jobs
+    jobs = list(run_jobs.JOBS)
+    try:
+        separate = sum(import_seconds([j]) for j in jobs)
+        runner = import_seconds(jobs)
+        print(f"{'imports':<10} {'separate':>10} {'runner':>10}")
+        print(f"{'seconds':<10} {separate:>10.2f} {runner:>10.2f}")
+
+        with redirect_stdout(io.StringIO()):
+            replay_jobs.run('cold')
+        results = {'separate': [], 'runner': []}
+        for _ in range(REPEAT):
+            results['separate'].append(nightly([[j] for j in jobs]))
+            results['runner'].append(nightly([jobs]))
+    finally:
+        stop()
+
+    print(f"\n{'nightly run':<12} {'seconds':>8} {'startup':>8} {'secrets':>8} {'webhooks':>9} {'sessions':>9}")
+    best = {}
+    for name, runs in results.items():
+        seconds, startup, calls = best[name] = min(runs)
+        print(f"{name:<12} {seconds:>8.2f} {startup:>8.2f} {calls['get_secret']:>8} {calls['get_webhook']:>9} "
+              f"{calls['get_session']:>9}")
+
+    secret_calls = {n: r[2]['get_secret'] + r[2]['get_webhook'] for n, r in best.items()}
+    if secret_calls['runner'] >= secret_calls['separate']:
+        sys.exit('The runner does not make fewer Secrets Manager calls than separate jobs.')
+    if best['runner'][1] >= best['separate'][1]:
+        sys.exit('The runner does not spend less time starting the jobs than separate jobs.')
+
+
+if __name__ == '__main__':
+    main()
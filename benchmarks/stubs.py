@@ -0,0 +1,80 @@
+import logging
+import time
+import sys
+import os
+
+# Stand-ins for the helpers of the private utils package, so the jobs can be run locally against
+# stubbed services. install() has to run before a job module is imported.
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET_LATENCY = float(os.getenv('SECRET_LATENCY', 0.05))    # seconds a Secrets Manager call takes
+SESSION_LATENCY = float(os.getenv('SESSION_LATENCY', 0.02))  # seconds creating a boto3 session takes
+
+calls = {'get_session': 0, 'get_secret': 0, 'get_webhook': 0}
+slack = []  # messages posted to Slack
+
+# One secret holding every key the jobs read
+SECRET = {'ID': 'stub-app-id', 'PAT_NAME': 'stub', 'PAT_VALUE': 'stub', 'host': 'localhost',
+          'user': 'stub', 'password': 'stub', 'database': 'wbx_data', 'port': 5439}
+
+# -------------------------------------- Functions --------------------------------------
+
+def get_logger():
+    logger = logging.getLogger('benchmark')
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+    return logger
+
+
+def get_session(creds):
+    import boto3
+    calls['get_session'] += 1
+    time.sleep(SESSION_LATENCY)
+    return boto3.Session(aws_access_key_id='testing', aws_secret_access_key='testing', region_name=creds['region'])
+
+
+def get_secret(name, session, region):
+    calls['get_secret'] += 1
+    time.sleep(SECRET_LATENCY)
+    return dict(SECRET)
+
+
+def get_webhook(session, creds):
+    calls['get_webhook'] += 1
+    time.sleep(SECRET_LATENCY)
+    return 'https://hooks.slack.invalid/stub'
+
+
+def send_slack_notification(webhook_url, message):
+    slack.append(message)
+
+
+def not_stubbed(*args, **kwargs):
+    raise RuntimeError('This benchmark does not stub this connection.')
+
+
+# Function to install the stand-in utils module. Connections default to raising; benchmarks
+# that need them pass factories returning local fakes.
+def install(get_rs_conn=not_stubbed, get_mysql_client=not_stubbed):
+    for name, value in {'RS_SECRET': 'rs', 'API_SECRET': 'api', 'PAT_VALUE': 'pat', 'ACCOUNT_ID': '000000000000',
+                        'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                        'AWS_DEFAULT_REGION': 'us-west-2'}.items():
+        os.environ.setdefault(name, value)
+
+    # The stand-in module is benchmarks/utils.py, so spawned worker processes import it too
+    for path in (os.path.dirname(os.path.abspath(__file__)), REPO):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    import utils
+    utils.get_rs_conn = get_rs_conn
+    utils.get_mysql_client = get_mysql_client
+    return utils
+
+
+def reset():
+    for k in calls:
+        calls[k] = 0
+    slack.clear()
@@ -0,0 +1,85 @@
+from contextlib import redirect_stdout
+import subprocess
+import tempfile
+import types
+import time
+import sys
+import io
+import os
+
+import stubs
+import fake_tableau
+
+# Compare the Tableau REST calls of the audit before and after the index/snapshot changes, on a
+# generated site of DATASOURCES datasources and TASKS refresh tasks.
+#
+#   python benchmarks/tableau_api_calls.py
+#
+# "before" is tableau_refreshes.py at BASELINE (the first commit by default). The current audit
+# runs twice: once with an empty snapshot and once more with nothing changed on the site. The
+# first current run has to post the same alerts as the baseline, leaving out the progress and
+# summary messages, and the run on the unchanged site has to post nothing.
+
+DATASOURCES = int(os.getenv('DATASOURCES', 500))
+TASKS = int(os.getenv('TASKS', 500))
+BASELINE = os.getenv('BASELINE') or subprocess.check_output(
+    ['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=stubs.REPO, text=True).split()[0]
+
+
+def load_baseline():
+    source = subprocess.check_output(['git', 'show', f'{BASELINE}:tableau_refreshes.py'], cwd=stubs.REPO, text=True)
+    module = types.ModuleType('tableau_refreshes_baseline')
+    exec(compile(source, 'tableau_refreshes_baseline.py', 'exec'), module.__dict__)
+    return module
+
+
+# Function to run an audit against the fake site. Returns the number of requests, the seconds
+# taken, the alerts posted to Slack and the number of Slack messages.
+def run(main, site):
+    stubs.reset()
+    mock = fake_tableau.serve(site)
+    started = time.monotonic()
+    try:
+        with redirect_stdout(io.StringIO()):
+            main()
+    finally:
+        mock.stop()
+    alerts = [normalize(m) for m in stubs.slack if m.startswith((':warning:', ':red-x-mark:'))]
+    return len(mock.calls), time.monotonic() - started, alerts, len(stubs.slack)
+
+
+# The baseline lists missing groups in set order, which changes with the hash seed
+def normalize(message):
+    lines = []
+    for line in message.split('\n'):
+        name, sep, groups = line.partition('    :    ')
+        lines.append(name + sep + ', '.join(sorted(groups.split(', '))) if sep else line)
+    return '\n'.join(lines)
+
+
+def main():
+    stubs.install()
+    os.environ['TABLEAU_SNAPSHOT_DB'] = os.path.join(tempfile.mkdtemp(), 'tableau_audit.db')
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp()
+    import tableau_refreshes
+
+    site = fake_tableau.Site(DATASOURCES, TASKS)
+    results = [
+        ('before', *run(load_baseline().main, site)),
+        ('after, empty snapshot', *run(tableau_refreshes.main, site)),
+        ('after, unchanged site', *run(tableau_refreshes.main, site))
+    ]
+
+    print(f"{DATASOURCES} datasources, {TASKS} tasks")
+    for name, calls, seconds, _, _ in results:
+        print(f"{name:<24} {calls:>6} API calls {seconds:>8.2f}s")
+    if results[1][3] != results[0][3]:
+        sys.exit('The current audit posts different alerts than the baseline.')
+    if results[2][4]:
+        sys.exit('The current audit posts to Slack when nothing changed on the site.')
+    if results[1][1] >= results[0][1]:
+        sys.exit('The current audit does not make fewer API calls than the baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+from stubs import get_logger, get_session, get_secret, get_webhook, send_slack_notification, not_stubbed
+
+# Stand-in for the private utils package. It is a module file rather than one built in memory so
+# that worker processes started with spawn can import the job modules too. stubs.install replaces
+# the connections with the fakes of each benchmark.
+
+get_rs_conn = not_stubbed
+get_mysql_client = not_stubbed
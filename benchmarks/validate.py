@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+import random
+import time
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+
+import stubs
+
+# Time cleaning ROWS manual transaction rows, before and after the vectorized validation stage.
+#
+#   python benchmarks/validate.py
+#
+# The rows are split in sheets of SHEET_ROWS rows, as openpyxl returns them: datetimes, integer
+# account ids and float amounts, with MISSING of the rows lacking an account id. "before" is the
+# per-sheet cleaning of manual_transactions.py at the first commit, then its concatenation, dropna
+# and astype(int). "after" concatenates the sheets as parse_files returns them and runs validate.
+# Both have to keep the same rows with the same dates, account ids and amounts. The baseline kept
+# amounts as floats, so the decimal parsing of parse_amount, part of "after", is also timed alone.
+
+ROWS = int(os.getenv('ROWS', 1000000))
+SHEET_ROWS = int(os.getenv('SHEET_ROWS', 10000))
+MISSING = float(os.getenv('MISSING', 0.01))
+
+# -------------------------------------- Functions --------------------------------------
+
+def make_sheets(rng, columns):
+    start = datetime(2024, 1, 1)
+    sheets = []
+    for first in range(0, ROWS, SHEET_ROWS):
+        rows = [(start + timedelta(days=rng.randint(0, 600)), None if rng.random() < MISSING else rng.randint(1000, 99999),
+                 rng.choice(['donations', 'tickets', 'memberships']), round(rng.uniform(-50, 5000), 2), 'Manual', 'x')
+                for _ in range(min(SHEET_ROWS, ROWS - first))]
+        sheets.append([tuple(columns) + ('Notes',)] + rows)
+    return sheets
+
+
+# The cleaning of manual_transactions.py at the first commit, on the values of each sheet
+def before(sheets):
+    dfs = []
+    for data in sheets:
+        df = pd.DataFrame(data)
+        df.columns = df.iloc[0]
+        df = df[1:]
+        df.reset_index(drop=True, inplace=True)
+        df = df.dropna(how='all')
+        df['Date'] = pd.to_datetime(df['Date']).dt.date
+        df['Account ID'] = df['Account ID'].apply(lambda x: f"{int(x):.0f}" if not pd.isna(x) else np.nan)
+        df = df[['Date', 'Account ID', 'Product', 'Amount', 'Source - Tableau (additional item)']]
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True)
+    df.columns = ['date_created', 'account_id', 'product', 'total', 'source']
+    df.dropna(subset=['account_id'], inplace=True)
+    df['account_id'] = df['account_id'].astype(int)
+    return df
+
+
+def after(chunks):
+    import manual_transactions as mt
+    df, quarantine = mt.validate(pd.concat(chunks, ignore_index=True))
+    return df
+
+
+def timed(fn, data):
+    started = time.monotonic()
+    result = fn(data)
+    return time.monotonic() - started, result
+
+
+def main():
+    stubs.install()
+    import manual_transactions as mt
+    sheets = make_sheets(random.Random(0), mt.COLUMNS)
+    chunks = [mt.convert_chunk([row[:len(mt.COLUMNS)] for row in data[1:]]) for data in sheets]
+    print(f"{ROWS} rows in sheets of {SHEET_ROWS}")
+
+    seconds, old = timed(before, sheets)
+    print(f"{'before':<8} {seconds:>8.2f}s")
+    seconds, new = timed(after, chunks)
+    print(f"{'after':<8} {seconds:>8.2f}s")
+    seconds, _ = timed(mt.parse_amount, pd.concat(chunks, ignore_index=True)['Amount'])
+    print(f"{'  amounts':<8} {seconds:>8.2f}s")
+
+    same = (len(old) == len(new)
+            and (pd.to_datetime(old['date_created']).values == pd.to_datetime(new['date_created'].astype(str)).values).all()
+            and (old['account_id'].values == new['account_id'].astype(np.int64).values).all()
+            and np.allclose(old['total'].astype(float).values, new['total'].astype(float).values))
+    if not same:
+        sys.exit('validate kept different rows than the per-sheet cleaning.')
+
+
+if __name__ == '__main__':
+    main()
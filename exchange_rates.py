@@ -1,35 +1,69 @@
-from utils import get_secret, get_session, get_rs_conn, get_logger, get_webhook, send_slack_notification
-from awswrangler import redshift
+from utils import get_rs_conn, get_logger, send_slack_notification
+from resources import get_secret, get_session, get_webhook
+from awswrangler import redshift, s3
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone, timedelta
 import redshift_connector
+import metrics
 import pandas as pd
+import numpy as np
+import threading
 import requests
+import json
+import gzip
+import time
 import os
 
 # Initialize variables
 API_URL = os.getenv('API_URL')
+FX_API_URL = os.getenv('FX_API_URL', 'https://openexchangerates.org/api')  # base of the historical rates endpoint
 API_SECRET = os.getenv('API_SECRET')
+MAX_IN_FLIGHT = int(os.getenv('FX_MAX_IN_FLIGHT', 8))      # concurrent requests to the API
+RATE_LIMIT = float(os.getenv('FX_RATE_LIMIT', 5))          # requests per second allowed by the plan
+RATE_BURST = int(os.getenv('FX_RATE_BURST', MAX_IN_FLIGHT))
+MAX_RETRIES = int(os.getenv('FX_MAX_RETRIES', 5))
+RETRY_BACKOFF = float(os.getenv('FX_RETRY_BACKOFF', 1))    # seconds, doubled on every retry
+FLUSH_DATES = int(os.getenv('FX_FLUSH_DATES', 500))        # dates per Parquet part written to S3
+STATE_FILE = os.getenv('FX_STATE_FILE', os.path.expanduser('~/.exchange_rates_state.json'))
+FULL_SCAN = os.getenv('FX_FULL_SCAN', '0') == '1'          # reconcile against the whole table
+CACHE_DIR = os.getenv('FX_CACHE_DIR', os.path.expanduser('~/.cache/exchange_rates'))
+CACHE_MAX_BYTES = int(os.getenv('FX_CACHE_MAX_BYTES', 512 * 1024 ** 2))
 creds = {"region": "us-west-2", "cluster_id": "wbx-data", "db": "wbx_data"}
 schema = creds['db']
 table = 'exchange_rates'
+daily_table = 'exchange_rates_daily'
 bucket_name = 'wbx-data.redshift-unload'
 prefix = 'raw/exchange_rates/'
 copy_mode = 'append'
+cache_stats = {'hits': 0, 'misses': 0}
+cache_lock = threading.Lock()
 
-# Set up Botocore session
-session = get_session(creds)
+# Function to initialize the session, Redshift connection and webhook when the job starts rather
+# than on import, so the module can be imported by run_jobs.py without side effects
+def init_globals():
+    global session, logger, conn, webhook_url
 
-# Get logger
-logger = get_logger()
-logger.info("Starting ...")
+    # Set up Botocore session
+    with metrics.span('session'):
+        session = get_session(creds)
 
-# Establishing Redshift connection
-logger.info("Establishing Redshift connection ...")
-rs_secret = get_secret(os.environ['RS_SECRET'], session, creds['region'])
-conn = get_rs_conn(rs_secret)
+    # Get logger
+    logger = get_logger()
+    logger.info("Starting ...")
+
+    # Establishing Redshift connection
+    logger.info("Establishing Redshift connection ...")
+    with metrics.span('secrets'):
+        rs_secret = get_secret(os.environ['RS_SECRET'], session, creds['region'])
+    with metrics.span('connect'):
+        conn = get_rs_conn(rs_secret)
+
+    # Set up webhook
+    with metrics.span('secrets'):
+        webhook_url = get_webhook(session, creds)
+    send_slack_notification(webhook_url, 'Fetching exchange rates :loading_dots:')
 
-# Set up webhook
-webhook_url = get_webhook(session, creds)
-send_slack_notification(webhook_url, 'Fetching exchange rates :loading_dots:')
 
 # Create the exchange_rates table in Redshift if it doesn't exist
 def create_table_and_insert_data(conn):
@@ -67,86 +101,477 @@ def create_table_and_insert_data(conn):
         cursor.execute(create_table_query)
         conn.commit()
 
+        # Holes saved for the dropped table no longer apply, so the full gap detection runs
+        # against the new one
+        if os.path.exists(STATE_FILE):
+            os.remove(STATE_FILE)
+            logger.info(f"Created {schema}.{table}, removed the saved state {STATE_FILE}.")
+
     cursor.execute(f'Grant all on all tables in schema {schema} to group admin;')
     conn.commit()
 
-# Fetch the dates from Redshift starting the the day after the last date in the exchange_rates table and ending with today
+# Load the gap-detection state saved by the last run: the run-length encoded ranges of dates
+# before the last loaded date that are still missing (holes). The last loaded date itself is
+# read from the table, so a run that dies after its COPY never requests the same dates again.
+def load_state():
+    if not os.path.exists(STATE_FILE):
+        return None
+    with open(STATE_FILE) as f:
+        return json.load(f)
+
+
+def save_state(holes):
+    with open(STATE_FILE, 'w') as f:
+        json.dump({'holes': holes}, f)
+    logger.info(f"Saved {len(holes)} known holes.")
+
+
+# Collapse a list of ISO dates into [start, end] ranges of consecutive days
+def to_ranges(days):
+    ranges = []
+    for day in sorted(days):
+        if ranges and datetime.fromisoformat(day) - datetime.fromisoformat(ranges[-1][1]) == timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return ranges
+
+
+# Fetch the dates missing from the exchange_rates table. By default only the dates after the
+# latest date in the table and the known holes are requested; the full anti-join against the table runs
+# when there is no saved state or FULL_SCAN is set.
 def get_dates(conn):
+    state = None if FULL_SCAN else load_state()
+    if state is None:
+        logger.info("Running full gap detection against the exchange_rates table ...")
+        missing = "full_date not in (select date from wbx_data.exchange_rates)"
+    else:
+        ranges = [f"full_date between '{start}' and '{end}'" for start, end in state['holes']]
+        ranges.append("full_date > (select coalesce(max(date), '1900-01-01') from wbx_data.exchange_rates)")
+        missing = "(" + " or ".join(ranges) + ")"
+
     dates = f"""
     select full_date
     from wbx_data_dbt.dim_dates
     where full_date >= '2015-01-01'
         and full_date <= getdate()
-        and full_date not in (select date from wbx_data.exchange_rates)
+        and {missing}
     order by full_date desc;
     """
     dates = pd.read_sql(dates, conn)
     return dates
 
 
-# Retreive historical exchange rates using the Open Exchange Rates API
+# Token bucket shared by the fetch threads so the request rate stays within the API plan quota
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Columnar accumulator for date/currency/rate triples. Rows are written into preallocated
+# NumPy buffers (grown by doubling) and currency codes are dictionary-encoded, so appending a
+# day costs the same no matter how many days are already buffered.
+class RateBuffer:
+    def __init__(self, capacity=200000):
+        self.dates = np.empty(capacity, dtype='datetime64[D]')
+        self.codes = np.empty(capacity, dtype=np.int16)
+        self.rates = np.empty(capacity, dtype=np.float64)
+        self.currencies = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, n):
+        needed = self.size + n
+        if needed <= len(self.rates):
+            return
+        capacity = max(needed, 2 * len(self.rates))
+        for name in ('dates', 'codes', 'rates'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    # Append the rates of one API response, stored as 1 / rate like the exchange_rates table
+    def append(self, date, rates):
+        n = len(rates)
+        self._reserve(n)
+        start, end = self.size, self.size + n
+        self.dates[start:end] = np.datetime64(date, 'D')
+        self.codes[start:end] = [self.currencies.setdefault(c, len(self.currencies)) for c in rates]
+        self.rates[start:end] = np.fromiter(rates.values(), dtype=np.float64, count=n)
+        with np.errstate(divide='ignore'):
+            np.reciprocal(self.rates[start:end], out=self.rates[start:end])
+        self.size = end
+
+    def to_frame(self):
+        names = np.array(list(self.currencies), dtype=object)
+        return pd.DataFrame({
+            'date': self.dates[:self.size].astype(object),
+            'currency': names[self.codes[:self.size]],
+            'rate': self.rates[:self.size].copy()
+        })
+
+    # Emit the buffered rows as a DataFrame and start over, keeping the currency dictionary
+    def flush(self):
+        frame = self.to_frame()
+        self.size = 0
+        return frame
+
+
+# Create an HTTP session whose connection pool is sized for the number of in-flight requests
+def get_http_session():
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_IN_FLIGHT)
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+
+# Fetch the rates for a single date, retrying with exponential backoff on 429 and 5xx responses,
+# connection errors and timeouts. Returns None when the request failed on every attempt.
+def fetch_rates(http, bucket, date, app_id):
+    url = f'{FX_API_URL}/historical/{date}.json'
+    params = {'app_id': app_id}
+
+    for attempt in range(MAX_RETRIES + 1):
+        bucket.acquire()
+        try:
+            response = http.get(url, params=params, timeout=30)
+        except requests.RequestException as e:
+            if attempt == MAX_RETRIES:
+                logger.error(f"Request for {date} failed after {MAX_RETRIES} retries: {e}")
+                return None
+            logger.warning(f"Request error for {date}: {e}. Retrying ...")
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+            continue
+
+        if response.status_code != 429 and response.status_code < 500:
+            return response
+        if attempt == MAX_RETRIES:
+            break
+
+        retry_after = response.headers.get('Retry-After', '')
+        delay = float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2 ** attempt
+        logger.warning(f"Got {response.status_code} for {date}. Retrying in {delay}s ...")
+        time.sleep(delay)
+
+    return response
+
+
+# Local cache of raw API responses, one gzipped JSON file per day. Historical rates never change,
+# so any job on the host can reuse a day once it has been downloaded.
+def cache_path(day):
+    return os.path.join(CACHE_DIR, f'{day}.json.gz')
+
+
+def read_cache(day):
+    path = cache_path(day)
+    try:
+        with gzip.open(path, 'rb') as f:
+            data = json.load(f)
+        os.utime(path)  # mark as recently used for eviction
+    except (OSError, ValueError):
+        with cache_lock:
+            cache_stats['misses'] += 1
+        return None
+
+    with cache_lock:
+        cache_stats['hits'] += 1
+    return data
+
+
+# Write through a temporary file so concurrent jobs never read a partial entry
+def write_cache(day, content):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cache_path(day)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with gzip.open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+# Remove the least recently used days until the cache fits in CACHE_MAX_BYTES
+def evict_cache():
+    if not os.path.isdir(CACHE_DIR):
+        return
+    # Another run sharing the cache may remove entries while they are scanned, so entries that
+    # disappeared are skipped
+    entries = []
+    for e in os.scandir(CACHE_DIR):
+        if e.name.endswith('.json.gz'):
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, e.path))
+    entries.sort()
+    size = sum(e[1] for e in entries)
+    evicted = 0
+    for _, entry_size, path in entries:
+        if size <= CACHE_MAX_BYTES:
+            break
+        size -= entry_size
+        try:
+            os.remove(path)
+            evicted += 1
+        except FileNotFoundError:
+            pass
+    logger.info(f"Rate cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {evicted} evicted.")
+
+
+# Return the status and rates for a date, reading the local cache before the API. Today's rates
+# are still moving, so they are never cached. A request that failed on every attempt returns
+# status 0 and no rates, so the date is kept as a hole.
+def get_rates(http, bucket, date, app_id):
+    day = str(np.datetime64(date, 'D'))
+    cacheable = day < str(datetime.now(timezone.utc).date())
+    if cacheable:
+        data = read_cache(day)
+        if data is not None:
+            return 200, data.get('rates', {})
+
+    response = fetch_rates(http, bucket, date, app_id)
+    if response is None:
+        return 0, {}
+    if response.status_code != 200:
+        return response.status_code, {}
+
+    data = response.json()
+    if cacheable and data.get('rates'):
+        write_cache(day, response.content)
+    return 200, data.get('rates', {})
+
+
+# Write a chunk of rates to S3 as its own Parquet part, named after the date range it covers
+def write_part(exchange_rates):
+    first, last = min(exchange_rates['date']), max(exchange_rates['date'])
+    path = f's3://{bucket_name}/{prefix}part-{first}_{last}.parquet'
+    with metrics.span('write_part'):
+        s3.to_parquet(df=exchange_rates, path=path, boto3_session=session)
+    metrics.count('rows', len(exchange_rates))
+    logger.info(f"Wrote {len(exchange_rates)} rows for {first} to {last} to {path}")
+    return path
+
+
+# Find the parts left behind by a run that failed before the COPY. Parts whose dates are all
+# already in the table were loaded before the run died and are removed.
+def get_pending_parts(missing):
+    parts = {}
+    stale = []
+    for path in s3.list_objects(f's3://{bucket_name}/{prefix}', suffix='.parquet', boto3_session=session):
+        part_dates = s3.read_parquet(path, columns=['date'], boto3_session=session)['date']
+        part_dates = {str(np.datetime64(d, 'D')) for d in part_dates}
+        if part_dates & missing:
+            parts[path] = part_dates
+        else:
+            stale.append(path)
+
+    if stale:
+        s3.delete_objects(stale, boto3_session=session)
+    return parts
+
+
+# Retreive historical exchange rates using the Open Exchange Rates API and stage them in S3
+# as Parquet parts of FLUSH_DATES dates each
 def fetch_exchange_rate_data():
 
-    dates = get_dates(conn)
+    with metrics.span('gaps'):
+        dates = get_dates(conn)
     if len(dates) > 0:
         logger.info(f"Fetching exchange rates starting from {min(dates['full_date'])}.")
-        exchange_rates = pd.DataFrame()
-        api_secret_response = get_secret(API_SECRET, session, creds['region'])
-
-        # Send GET request to the Open Exchange Rates API
-        for date in dates['full_date'].values:
-            url = f'https://openexchangerates.org/api/historical/{date}.json'
-            params = {'app_id': api_secret_response['ID']}
-
-            response = requests.get(url, params=params)
-            if response.status_code == 401:
-                return 'Error retrieving data from the API'
-            data = response.json().get('rates', {})
-            rates = pd.DataFrame(list(data.items()), columns=['currency', 'rate'])
-            rates['date'] = date
-            rates['rate'] = 1 / rates['rate']
-            rates = rates[['date', 'currency', 'rate']]
-            exchange_rates = pd.concat([exchange_rates, rates], ignore_index=True)
-            logger.info(f"{len(rates)} rows added for date {date}. Total : {len(exchange_rates)}")
+        date_values = dates['full_date'].values
 
-        if len(exchange_rates) == 0:
+        # Skip the dates already staged by a previous run
+        with metrics.span('pending_parts'):
+            pending = get_pending_parts({str(np.datetime64(d, 'D')) for d in date_values})
+        parts = list(pending)
+        staged = set().union(*pending.values())
+        if staged:
+            logger.info(f"Reusing {len(parts)} parts covering {len(staged)} dates from a previous run.")
+        date_values = [d for d in date_values if str(np.datetime64(d, 'D')) not in staged]
+
+        exchange_rates = RateBuffer()
+        total = 0
+        empty = []
+        with metrics.span('secrets'):
+            api_secret_response = get_secret(API_SECRET, session, creds['region'])
+        app_id = api_secret_response['ID']
+        bucket = TokenBucket(RATE_LIMIT, RATE_BURST)
+
+        # Send GET requests to the Open Exchange Rates API, MAX_IN_FLIGHT at a time
+        with metrics.span('fetch'), get_http_session() as http, ThreadPoolExecutor(MAX_IN_FLIGHT) as executor:
+            responses = executor.map(lambda d: get_rates(http, bucket, d, app_id), date_values)
+            for i, (date, (status, rates)) in enumerate(zip(date_values, responses), 1):
+                if status == 401:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    if len(exchange_rates) > 0:
+                        write_part(exchange_rates.flush())
+                    return 'Error retrieving data from the API'
+                exchange_rates.append(date, rates)
+                total += len(rates)
+                metrics.count('api_dates')
+                if len(rates) == 0:
+                    empty.append(str(np.datetime64(date, 'D')))
+                logger.info(f"{len(rates)} rows added for date {date}. Total : {total}")
+
+                if i % FLUSH_DATES == 0 and len(exchange_rates) > 0:
+                    parts.append(write_part(exchange_rates.flush()))
+
+        if len(exchange_rates) > 0:
+            parts.append(write_part(exchange_rates.flush()))
+        evict_cache()
+        metrics.count('cache_hits', cache_stats['hits'])
+        metrics.count('cache_misses', cache_stats['misses'])
+
+        if len(parts) == 0:
             return 'Exceeded request rate limit'
-        return exchange_rates
+
+        # Dates the API returned nothing for are kept as holes and requested again next run. Every
+        # known hole was requested in this run, so the new list replaces the saved one. It is
+        # saved before the COPY: if the load fails, its dates are still after the table's last date.
+        save_state(to_ranges(empty))
+        return parts
     else:
         return False
 
-# Copy the exchange rates data to Redshift by first uploading the data to S3
-def copy_to_redshift(exchange_rates):
-    logger.info("Writing to Redshift ...")
-    redshift.copy(
-                df = exchange_rates,
-                path = f's3://{bucket_name}/raw/temp.csv',
-                con = conn,
-                table = table,
-                schema = creds['db'],
-                mode = copy_mode,
-                overwrite_method = "drop",
-                boto3_session = session
-            )
+# Copy the staged Parquet parts to Redshift with a single manifest-based COPY
+def copy_to_redshift(parts):
+    logger.info(f"Writing {len(parts)} parts to Redshift ...")
+
+    sizes = s3.size_objects(parts, boto3_session=session)
+    metrics.count('bytes', sum(sizes.values()))
+    manifest = {'entries': [{'url': p, 'mandatory': True, 'meta': {'content_length': sizes[p]}} for p in parts]}
+    manifest_path = f's3://{bucket_name}/{prefix}manifest.json'
+    session.client('s3').put_object(Bucket=bucket_name, Key=f'{prefix}manifest.json', Body=json.dumps(manifest))
+
+    with metrics.span('copy'):
+        redshift.copy_from_files(
+                    path = manifest_path,
+                    con = conn,
+                    table = table,
+                    schema = creds['db'],
+                    mode = copy_mode,
+                    manifest = True,
+                    boto3_session = session
+                )
 
     # Grant permissions to the new table
-    conn.cursor().execute(f"GRANT ALL ON ALL TABLES in SCHEMA {creds['db']} to group admin;")
-    conn.commit()
-    conn.close()
+    with metrics.span('grants'):
+        conn.cursor().execute(f"GRANT ALL ON ALL TABLES in SCHEMA {creds['db']} to group admin;")
+        conn.commit()
+
+    # The parts are only removed once the COPY has been committed
+    s3.delete_objects(parts + [manifest_path], boto3_session=session)
+
+
+# Build a dense day x currency rate matrix from the exchange_rates table. Days without a rate are
+# forward-filled from the last known day up to today, and every day carries the average rate of
+# its calendar month. Returns the matrix flattened to rows in (day_key, currency) order.
+def build_rate_matrix(exchange_rates):
+    dates = pd.to_datetime(exchange_rates['date']).values.astype('datetime64[D]')
+    currencies, codes = np.unique(exchange_rates['currency'].values.astype(str), return_inverse=True)
+    start = dates.min()
+    end = max(dates.max(), np.datetime64(datetime.now(timezone.utc).date(), 'D'))
+    days = np.arange(start, end + 1)
+
+    matrix = np.full((len(days), len(currencies)), np.nan)
+    matrix[(dates - start).astype(int), codes] = exchange_rates['rate'].values
+
+    # Forward-fill each column with the index of the last row holding a rate
+    missing = np.isnan(matrix)
+    last = np.where(missing, 0, np.arange(len(days))[:, None])
+    np.maximum.accumulate(last, axis=0, out=last)
+    filled = matrix[last, np.arange(len(currencies))]
+
+    # Monthly averages, repeated over the days of each month
+    valid = ~np.isnan(filled)
+    months = days.astype('datetime64[M]')
+    month_starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+    sums = np.add.reduceat(np.where(valid, filled, 0), month_starts, axis=0)
+    counts = np.add.reduceat(valid, month_starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        monthly = np.repeat(sums / counts, np.diff(np.r_[month_starts, len(days)]), axis=0)
+
+    # Days before a currency's first rate stay empty and are left out
+    day_idx, cur_idx = np.nonzero(valid)
+    return pd.DataFrame({
+        'day_key': days.astype(np.int32)[day_idx],  # days since 1970-01-01, numpy's own day number
+        'date': days[day_idx].astype(object),
+        'currency': currencies[cur_idx],
+        'rate': filled[day_idx, cur_idx],
+        'monthly_avg_rate': monthly[day_idx, cur_idx],
+        'is_filled': missing[day_idx, cur_idx]
+    })
+
+
+# Rebuild the exchange_rates_daily table, sorted on (day_key, currency), for the retention models
+def load_rate_matrix():
+    with metrics.span('rate_matrix'):
+        logger.info(f"Building {daily_table} ...")
+        with metrics.span('read'):
+            exchange_rates = pd.read_sql(f"select date, currency, rate from {schema}.{table};", conn)
+        if len(exchange_rates) == 0:
+            return
+        with metrics.span('build'):
+            daily = build_rate_matrix(exchange_rates)
+        logger.info(f"{len(daily)} rows in {daily_table}, {int(daily['is_filled'].sum())} forward-filled.")
+
+        with metrics.span('copy'):
+            redshift.copy(
+                        df = daily,
+                        path = f's3://{bucket_name}/raw/{daily_table}/',
+                        con = conn,
+                        table = daily_table,
+                        schema = creds['db'],
+                        mode = "overwrite",
+                        overwrite_method = "delete",
+                        diststyle = "ALL",
+                        sortkey = ['day_key', 'currency'],
+                        boto3_session = session
+                    )
+        with metrics.span('grants'):
+            conn.cursor().execute(f"GRANT ALL ON ALL TABLES in SCHEMA {creds['db']} to group admin;")
+            conn.commit()
 
 
 def main():
+    metrics.start_run('exchange_rates')
+    init_globals()
     create_table_and_insert_data(conn)
     exchange_rates = fetch_exchange_rate_data()
     if isinstance(exchange_rates, str):
         logger.error(exchange_rates)
+        metrics.finish('error')
         send_slack_notification(webhook_url, ":red-x-mark: " + exchange_rates)
-    elif isinstance(exchange_rates, pd.DataFrame):
+    elif isinstance(exchange_rates, list):
         copy_to_redshift(exchange_rates)
-        send_slack_notification(webhook_url, 'Exchange rates updated :white_check_mark:')
+        load_rate_matrix()
+        send_slack_notification(webhook_url, f'Exchange rates updated :white_check_mark: {metrics.finish()}')
     else:
+        if load_state() is None:
+            save_state([])
+        load_rate_matrix()
         logger.info('Table was already up to date.')
-        send_slack_notification(webhook_url, 'Table was already up to date :thumbsup:')
+        send_slack_notification(webhook_url, f'Table was already up to date :thumbsup: {metrics.finish()}')
+    conn.close()
     
 
 
@@ -1,114 +1,334 @@
 from openpyxl import load_workbook
 from awswrangler import redshift
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from io import BytesIO
+import multiprocessing as mp
 import pandas as pd
+import pyarrow as pa
 import numpy as np
+import metrics
+import json
 import os
-from utils import get_session, get_secret, get_rs_conn, send_slack_notification, get_webhook, get_logger
+from utils import get_rs_conn, send_slack_notification, get_logger
+from resources import get_session, get_secret, get_webhook
+
+MAX_WORKERS = int(os.getenv('MT_MAX_WORKERS', os.cpu_count() or 4))
+CHUNK_ROWS = int(os.getenv('MT_CHUNK_ROWS', 50000))
+COLUMNS = ['Date', 'Account ID', 'Product', 'Amount', 'Source - Tableau (additional item)']
+FULL_REFRESH = os.getenv('MT_FULL_REFRESH', '0') == '1'
+AMOUNT_TYPE = pa.decimal128(18, 2)
+AMOUNT_LIMIT = Decimal(10) ** 16  # exclusive bound of decimal(18, 2)
 
 # -------------------------------------- Functions --------------------------------------
 
 # Function to initialize global varaibles
 def init_globals():
-    global logger, session, bucket_name, s3, creds, conn, session
+    global logger, session, bucket_name, s3, s3_client, creds, conn, session
     logger = get_logger()
     creds = {'db': 'wbx_data', 'cluster_id': 'wbx-data', 'region': 'us-west-2'}
     bucket_name = 'wbx-data.redshift-unload'
 
     # Initializing Botocore session
     logger.info("Initializing Botocore session ...")
-    session = get_session(creds)
-    s3 = session.resource('s3')
+    with metrics.span('session'):
+        session = get_session(creds)
+        s3 = session.resource('s3')
+        s3_client = session.client('s3')  # clients, unlike resources, are thread-safe
 
     # Establishing Redshift connection
     logger.info("Establishing Redshift connection ...")
-    rs_secret = get_secret(os.environ['RS_SECRET'], session, creds['region'])
-    conn = get_rs_conn(rs_secret)
+    with metrics.span('secrets'):
+        rs_secret = get_secret(os.environ['RS_SECRET'], session, creds['region'])
+    with metrics.span('connect'):
+        conn = get_rs_conn(rs_secret)
+
+
+# Function to download a workbook from S3, run in the download thread pool
+def download_file(key):
+    return s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+
+
+# Function to turn a batch of raw rows into a DataFrame. Values are kept as read so that rows
+# failing validation can be quarantined untouched.
+def convert_chunk(rows):
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+# Generator streaming the sheets of a workbook in read-only mode. Only the needed columns are
+# kept and rows are yielded as DataFrames of at most chunk_rows rows.
+def iter_workbook_chunks(body, chunk_rows=CHUNK_ROWS):
+    workbook = load_workbook(BytesIO(body), read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            idx = [list(header).index(c) for c in COLUMNS]
+
+            batch = []
+            for row in rows:
+                values = tuple(row[i] if i < len(row) else None for i in idx)
+                if all(v is None for v in values):
+                    continue
+                batch.append(values)
+                if len(batch) == chunk_rows:
+                    yield convert_chunk(batch)
+                    batch = []
+            if batch:
+                yield convert_chunk(batch)
+    finally:
+        workbook.close()
+
+
+# Function to parse all sheets of a workbook, run in the parser process pool. The sheets are
+# streamed in chunks, so the worker never holds the openpyxl cells of the whole workbook; the
+# parsed rows of the workbook are returned as one DataFrame. The parent still keeps the frames of
+# every parsed file until they are loaded, so its memory grows with the files that changed.
+def parse_workbook(body):
+    dfs = list(iter_workbook_chunks(body))
+    if not dfs:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(dfs, ignore_index=True)
+
+
+# Function to download and parse a list of files, returning one DataFrame per file in order
+def parse_files(files):
+    if not files:
+        return []
+
+    # Download the files concurrently and parse them in worker processes as they arrive.
+    # Results are collected in the order of the file listing. The workers start while the download
+    # threads are in the middle of boto3 requests, so they are forked from a fork server that has
+    # only imported this module rather than from this process.
+    context = mp.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    parsers = ProcessPoolExecutor(MAX_WORKERS, mp_context=context)
+    logger.info(f"Fetching {len(files)} files from S3 with {MAX_WORKERS} workers ...")
+    with ThreadPoolExecutor(MAX_WORKERS) as downloads, parsers:
+        futures = [parsers.submit(parse_workbook, body) for body in downloads.map(download_file, files)]
+        return [f.result() for f in futures]
+
+
+# Function to turn a cleaned amount string into a Decimal rounded half up to cents. Returns None
+# for missing values, text that is not a number and values outside decimal(18, 2).
+def to_decimal(text, negative):
+    if not isinstance(text, str):
+        return None
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        return None
+    if not amount.is_finite():
+        return None
+    amount = amount.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    if abs(amount) >= AMOUNT_LIMIT:
+        return None
+    return -amount if negative else amount
+
+
+# Function to parse amounts such as 1234.5, "$1,234.50" or "(12.00)" into decimal(18, 2). The
+# cleaned text is parsed with decimal.Decimal, so amounts never pass through a binary float.
+def parse_amount(raw):
+    text = raw.astype('string').str.strip()
+    negative = (text.str.startswith('(') & text.str.endswith(')')).fillna(False)
+    text = text.str.replace(r'[$,()\s]', '', regex=True)
+
+    amounts = [to_decimal(t, n) for t, n in zip(text.tolist(), negative.tolist())]
+    valid = np.array([a is not None for a in amounts], dtype=bool)
+    parsed = pa.array(amounts, type=AMOUNT_TYPE)
+    return pd.Series(pd.arrays.ArrowExtensionArray(parsed), index=raw.index), valid
+
+
+# Function to validate and type the combined frame in one vectorized pass. Rows without an
+# account id are dropped as before; rows whose date, account id or amount cannot be parsed are
+# returned separately with the reason instead of failing the load.
+def validate(df):
+    df = df.rename(columns=dict(zip(COLUMNS, ['date_created', 'account_id', 'product', 'total', 'source'])))
+    df = df[df['account_id'].notna()]
+
+    date = pd.to_datetime(df['date_created'], errors='coerce')
+    account_id = pd.to_numeric(df['account_id'], errors='coerce')
+    total, valid_total = parse_amount(df['total'])
 
+    reasons = pd.Series('', index=df.index)
+    reasons = reasons.where(~(df['date_created'].notna() & date.isna()), reasons + 'date;')
+    reasons = reasons.where(~(account_id.isna() | (account_id % 1 != 0)), reasons + 'account_id;')
+    reasons = reasons.where(~(df['total'].notna() & ~valid_total), reasons + 'total;')
+    bad = reasons != ''
 
-# Function to load manual transactions
+    quarantine = df[bad].assign(reason=reasons[bad].str.rstrip(';'))
+
+    ok = ~bad
+    df = df[ok].assign(
+        date_created=pd.arrays.ArrowExtensionArray(pa.array(date[ok].dt.normalize()).cast(pa.date32())),
+        account_id=account_id[ok].astype('Int64'),
+        product=df.loc[ok, 'product'].astype('category'),
+        total=total[ok],
+        source=df.loc[ok, 'source'].astype('category')
+    )
+    return df, quarantine
+
+
+# Function to validate the parsed frames and write the rejected rows to a quarantine file in S3
+def prepare(prefix, dfs):
+    with metrics.span('validate'):
+        df, quarantine = validate(pd.concat(dfs, ignore_index=True))
+    metrics.count('rows', len(df))
+    metrics.count('quarantined_rows', len(quarantine))
+    if len(quarantine) > 0:
+        key = f"{prefix}quarantine/{pd.Timestamp.now(tz='UTC'):%Y%m%dT%H%M%S}.csv"
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=quarantine.to_csv(index=False).encode())
+        logger.warning(f"{len(quarantine)} invalid rows quarantined to s3://{bucket_name}/{key}")
+    return df
+
+
+# Function to read the manifest of S3 key -> ETag/LastModified/row fingerprint saved by the last run
+def read_manifest(prefix):
+    try:
+        body = s3_client.get_object(Bucket=bucket_name, Key=f'{prefix}_manifest.json')['Body'].read()
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+    return json.loads(body)
+
+
+def write_manifest(prefix, manifest):
+    s3_client.put_object(Bucket=bucket_name, Key=f'{prefix}_manifest.json', Body=json.dumps(manifest))
+
+
+# Function to check whether a table has the current layout: source_file tracking and a decimal total
+def is_current_schema(table_name):
+    cursor = conn.cursor()
+    cursor.execute(f"""
+    select column_name, data_type
+    from information_schema.columns
+    where table_schema = '{creds['db']}'
+        and table_name = '{table_name}'
+        and column_name in ('source_file', 'total');
+    """)
+    columns = dict(cursor.fetchall())
+    return 'source_file' in columns and columns.get('total') == 'numeric'
+
+
+# Function to load manual transactions. Only workbooks that are new or whose ETag changed since
+# the last run are parsed; their rows replace the previous rows of the same source file.
 def load_manual_transactions(table_name):
     global logger, bucket_name, s3, creds, conn
     
     # Get all files in the bucket
     bucket = s3.Bucket(bucket_name)
     prefix = f'raw/{table_name}/'
-    files = [obj.key for obj in bucket.objects.filter(Prefix=prefix) if obj.key.endswith('.xlsx')]
-
-    all_dfs = []
-    # Read all files and append to a list
-    logger.info("Fetching data from S3 ...")
-    for file in files:
-        obj = s3.Object(bucket_name, file)
-        body = obj.get()['Body'].read()
-
-        # Load the workbook from the in-memory file object
-        file_stream = BytesIO(body)
-        workbook = load_workbook(file_stream)
-        
-        dfs = []
-        # Iterate over each sheet
-        for s in workbook.sheetnames:
-            sheet = workbook[s]
-            data = sheet.values
-            df = pd.DataFrame(data)
-            df.columns = df.iloc[0]
-            df = df[1:]
-            df.reset_index(drop=True, inplace=True)
-            df = df.dropna(how='all')
-            df['Date'] = pd.to_datetime(df['Date']).dt.date
-            df['Account ID'] = df['Account ID'].apply(lambda x: f"{int(x):.0f}" if not pd.isna(x) else np.nan)
-            df = df[['Date', 'Account ID', 'Product', 'Amount', 'Source - Tableau (additional item)']]
-            dfs.append(df)
-
-        # Concatenate all DataFrames into one
-        combined_df = pd.concat(dfs, ignore_index=True)
-        all_dfs.append(combined_df)
-
-    # Combine all dataframes
-    all_combined_df = pd.concat(all_dfs, ignore_index=True)
-    all_combined_df.columns = ['date_created', 'account_id', 'product', 'total', 'source']
-    all_combined_df.dropna(subset=['account_id'], inplace= True)
-    all_combined_df['account_id'] = all_combined_df['account_id'].astype(int)
-  
-    # Drop table
-    conn.cursor().execute(f"DROP TABLE IF EXISTS {creds['db']}.{table_name} CASCADE;")
-
-    # Write to Redshift
-    logger.info("Writing to Redshift ...")
-    redshift.copy(
-                df = all_combined_df,
-                path = f's3://{bucket_name}/raw/temp.csv',
-                con = conn,
-                table = table_name,
-                schema = creds['db'],
-                mode = "overwrite",
-                overwrite_method = "drop",
-                boto3_session = session
-            )
+    with metrics.span('list'):
+        objects = {obj.key: obj for obj in bucket.objects.filter(Prefix=prefix) if obj.key.endswith('.xlsx')}
+
+        # A table created with an older layout has to be rebuilt once
+        incremental = not FULL_REFRESH and is_current_schema(table_name)
+        manifest = read_manifest(prefix) if incremental else {}
+
+    files = [k for k, obj in objects.items() if manifest.get(k, {}).get('etag') != obj.e_tag]
+    removed = [k for k in manifest if k not in objects]
+    if incremental and not files and not removed:
+        logger.info(f"No changes under {prefix}.")
+        return
+
+    # Re-saved workbooks whose rows are unchanged only need their manifest entry updated
+    new_manifest = {k: v for k, v in manifest.items() if k in objects}
+    changed = []
+    changed_dfs = []
+    metrics.count('files', len(files))
+    metrics.count('bytes', sum(objects[k].size for k in files))
+    with metrics.span('parse'):
+        parsed = parse_files(files)
+    for key, df in zip(files, parsed):
+        fingerprint = str(pd.util.hash_pandas_object(df, index=False).sum())
+        if manifest.get(key, {}).get('fingerprint') != fingerprint:
+            changed.append(key)
+            changed_dfs.append(df.assign(source_file=key))
+        new_manifest[key] = {
+            'etag': objects[key].e_tag,
+            'last_modified': objects[key].last_modified.isoformat(),
+            'rows': len(df),
+            'fingerprint': fingerprint
+        }
+
+    if incremental:
+        logger.info(f"{len(changed)} changed and {len(removed)} removed files under {prefix}.")
+
+        # Delete the rows of the changed and removed files, then append the new ones. The COPY
+        # commits the delete with it.
+        stale = changed + removed
+        if stale:
+            # Quotes in file names, e.g. O'Brien.xlsx, are doubled to stay inside the SQL literals
+            keys = ', '.join("'" + k.replace("'", "''") + "'" for k in stale)
+            with metrics.span('delete'):
+                conn.cursor().execute(f"DELETE FROM {creds['db']}.{table_name} WHERE source_file IN ({keys});")
+
+        if changed_dfs:
+            df = prepare(prefix, changed_dfs)
+            logger.info("Writing to Redshift ...")
+            with metrics.span('copy'):
+                redshift.copy(
+                            df = df,
+                            path = f's3://{bucket_name}/raw/temp.csv',
+                            con = conn,
+                            table = table_name,
+                            schema = creds['db'],
+                            mode = "append",
+                            boto3_session = session
+                        )
+        conn.commit()
+
+    else:
+        all_combined_df = prepare(prefix, changed_dfs)
+
+        # Only a table with an older layout is dropped; otherwise rows are replaced in place so
+        # dependent views survive
+        if not is_current_schema(table_name):
+            conn.cursor().execute(f"DROP TABLE IF EXISTS {creds['db']}.{table_name} CASCADE;")
+
+        # Write to Redshift
+        logger.info("Writing to Redshift ...")
+        with metrics.span('copy'):
+            redshift.copy(
+                        df = all_combined_df,
+                        path = f's3://{bucket_name}/raw/temp.csv',
+                        con = conn,
+                        table = table_name,
+                        schema = creds['db'],
+                        mode = "overwrite",
+                        overwrite_method = "delete",
+                        boto3_session = session
+                    )
+
+    write_manifest(prefix, new_manifest)
     
     
 # -------------------------------------- Start --------------------------------------
 
 def main():
+    metrics.start_run('manual_transactions')
     init_globals()
     logger.info("Starting ...")
 
-    webhook_url = get_webhook(session, creds)
+    with metrics.span('secrets'):
+        webhook_url = get_webhook(session, creds)
     send_slack_notification(webhook_url, 'Loading manual transactions :loading_dots:')
 
     table_names = ['manual_transactions', 'manual_transactions_pp']
 
     for t in table_names:
-        load_manual_transactions(t)
+        with metrics.span(t):
+            load_manual_transactions(t)
 
     # Grant permissions to the new tables
-    conn.cursor().execute(f"GRANT ALL ON ALL TABLES in SCHEMA {creds['db']} to group admin;")
-    conn.commit()
+    with metrics.span('grants'):
+        conn.cursor().execute(f"GRANT ALL ON ALL TABLES in SCHEMA {creds['db']} to group admin;")
+        conn.commit()
     conn.close()
     
     logger.info("Done!")
-    send_slack_notification(webhook_url, 'Manual transactions loaded :white_check_mark:')
+    send_slack_notification(webhook_url, f'Manual transactions loaded :white_check_mark: {metrics.finish()}')
 
 
 if __name__ == '__main__':
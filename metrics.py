@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from utils import get_logger
+import threading
+import resource
+import json
+import time
+import os
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.expanduser('~/.job_metrics'))
+SLOWER_THAN = float(os.getenv('SLOWER_THAN', 1.5))  # span time ratio to the last run that gets logged as a regression
+
+lock = threading.Lock()
+local = threading.local()  # run and stack of open span names of each thread
+
+# -------------------------------------- Functions --------------------------------------
+
+# Function to return the peak resident set size in MB of this process and of its finished child
+# processes (ru_maxrss is in kilobytes on Linux). Both are peaks over the life of the process, so
+# they are only reported per run; under run_jobs.py they include the jobs run before or beside it.
+def peak_rss():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(own / 1024, 1), round(children / 1024, 1)
+
+
+# Function to start collecting the metrics of a job run. The run belongs to the calling thread,
+# so jobs run side by side by run_jobs.py keep separate metrics. Spans and counters recorded
+# outside a run are ignored, so instrumented functions can also be used on their own.
+def start_run(job):
+    run = local.run = {
+        'job': job,
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'clock': time.monotonic(),
+        'spans': {},
+        'counters': {}
+    }
+    local.stack = []
+    return run
+
+
+# Function to add a duration to the span at path. Spans are keyed by their path, e.g.
+# "fetch/parse", and repeated spans are summed with their number of calls.
+def add_span(path, seconds):
+    run = getattr(local, 'run', None)
+    if run is None:
+        return
+    with lock:
+        span = run['spans'].setdefault(path, {'seconds': 0.0, 'calls': 0})
+        span['seconds'] = round(span['seconds'] + seconds, 3)
+        span['calls'] += 1
+
+
+# Context manager timing a stage of the job. Spans opened inside it are nested under its name.
+# The run belongs to the thread that started it, so spans opened in other threads, e.g. of a
+# worker pool, are not recorded.
+@contextmanager
+def span(name):
+    stack = get_stack()
+    stack.append(name)
+    path = '/'.join(stack)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        add_span(path, time.monotonic() - started)
+        stack.pop()
+
+
+# Function to record a duration measured elsewhere, e.g. returned by a worker process, as a span
+# nested under the spans open in this thread
+def record(name, seconds):
+    add_span('/'.join(get_stack() + [name]), seconds)
+
+
+def get_stack():
+    if not hasattr(local, 'stack'):
+        local.stack = []
+    return local.stack
+
+
+# Function to add to a counter such as rows or bytes
+def count(name, n=1):
+    run = getattr(local, 'run', None)
+    if run is None:
+        return
+    with lock:
+        run['counters'][name] = run['counters'].get(name, 0) + int(n)
+
+
+# Function to log the spans that got slower than SLOWER_THAN times their duration in the last run
+def compare(previous, current):
+    logger = get_logger()
+    for path, span in current['spans'].items():
+        before = previous.get('spans', {}).get(path, {}).get('seconds')
+        if before and span['seconds'] > max(before * SLOWER_THAN, before + 1):
+            logger.warning(f"Span {path} took {span['seconds']:.1f}s, {before:.1f}s in the last run.")
+
+
+# Function to finish the current run and write its metrics to METRICS_DIR/<job>/<start>.json.
+# Keys are sorted so two runs can be compared with a plain diff; latest.json always holds the
+# last run. Returns a one line summary of the top level spans for the Slack notification.
+def finish(status='ok'):
+    current = getattr(local, 'run', None)
+    if current is None:
+        return ''
+    local.run = None
+
+    own, children = peak_rss()
+    current['status'] = status
+    current['seconds'] = round(time.monotonic() - current.pop('clock'), 3)
+    current['peak_rss_mb'] = own
+    current['children_peak_rss_mb'] = children
+
+    directory = os.path.join(METRICS_DIR, current['job'])
+    os.makedirs(directory, exist_ok=True)
+    latest = os.path.join(directory, 'latest.json')
+    if os.path.exists(latest):
+        with open(latest) as f:
+            compare(json.load(f), current)
+
+    body = json.dumps(current, indent=2, sort_keys=True)
+    stamp = current['started_at'].replace(':', '').replace('-', '')[:15]
+    for path in (os.path.join(directory, f'{stamp}.json'), latest):
+        with open(path, 'w') as f:
+            f.write(body)
+    get_logger().info(f"Metrics written to {os.path.join(directory, f'{stamp}.json')}")
+
+    top = ', '.join(f"{p} {s['seconds']:.1f}s" for p, s in current['spans'].items() if '/' not in p)
+    return f"{current['seconds']:.1f}s ({top}), peak RSS {max(own, children):.0f} MB"
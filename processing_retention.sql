@@ -1,4 +1,27 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key='account_id',
+        incremental_strategy='delete+insert',
+        on_schema_change='append_new_columns'
+    )
+}}
+
+-- Incremental runs rebuild the accounts refreshed in processing_retention_aux since the last run.
+-- Run with --full-refresh to pick up changes to attribution, industries or max_ttm for every account.
+-- The first run over a table built before refreshed_at existed adds the column, empty for every row,
+-- and rebuilds every account.
 WITH
+retention_aux AS (
+    SELECT *
+    FROM {{ ref('processing_retention_aux') }}
+    {% if is_incremental() %}
+        WHERE
+            (SELECT MAX(refreshed_at) FROM {{ this }}) IS NULL
+            OR refreshed_at > (SELECT MAX(refreshed_at) FROM {{ this }})
+    {% endif %}
+),
+
 product_totals AS (
     SELECT
         account_id,
@@ -10,71 +33,32 @@ product_totals AS (
         SUM(monthly_trailing_total) AS monthly_trailing_total_product,
         SUM(ttm_trailing_total) AS ttm_trailing_total_product,
         SUM(ytd_trailing_total) AS ytd_trailing_total_product
-    FROM {{ ref('processing_retention_aux') }}
+    FROM retention_aux
     GROUP BY 1, 2, 3
 ),
 
-monthly_future_total AS (
+-- Last month with a positive total for each account and product
+last_positive_dates AS (
     SELECT
-        b.account_id,
-        b.product,
-        b.date,
-        MAX(b2.date) AS future_date
-    FROM {{ ref('processing_retention_aux') }} AS b
-    LEFT JOIN {{ ref('processing_retention_aux') }} AS b2
-        ON
-            b.account_id = b2.account_id
-            AND b.product = b2.product
-            AND b.date < b2.date
-    LEFT JOIN product_totals AS pt
-        ON
-            b2.account_id = pt.account_id
-            AND b2.product = pt.product
-            AND b2.date = pt.date
-    WHERE pt.monthly_total_product > 0
-    GROUP BY 1, 2, 3
-),
-
-ttm_future_total AS (
-    SELECT
-        b.account_id,
-        b.product,
-        b.date,
-        MAX(b2.date) AS future_date
-    FROM {{ ref('processing_retention_aux') }} AS b
-    LEFT JOIN {{ ref('processing_retention_aux') }} AS b2
-        ON
-            b.account_id = b2.account_id
-            AND b.product = b2.product
-            AND b.date < b2.date
-    LEFT JOIN product_totals AS pt
-        ON
-            b2.account_id = pt.account_id
-            AND b2.product = pt.product
-            AND b2.date = pt.date
-    WHERE pt.ttm_total_product > 0
-    GROUP BY 1, 2, 3
+        account_id,
+        product,
+        date,
+        MAX(CASE WHEN monthly_total_product > 0 THEN date END) OVER (PARTITION BY account_id, product) AS last_monthly_date,
+        MAX(CASE WHEN ttm_total_product > 0 THEN date END) OVER (PARTITION BY account_id, product) AS last_ttm_date,
+        MAX(CASE WHEN ytd_total_product > 0 THEN date END) OVER (PARTITION BY account_id, product) AS last_ytd_date
+    FROM product_totals
 ),
 
-ytd_future_total AS (
+-- The last positive month, for the months that come before it
+future_dates AS (
     SELECT
-        b.account_id,
-        b.product,
-        b.date,
-        MAX(b2.date) AS future_date
-    FROM {{ ref('processing_retention_aux') }} AS b
-    LEFT JOIN {{ ref('processing_retention_aux') }} AS b2
-        ON
-            b.account_id = b2.account_id
-            AND b.product = b2.product
-            AND b.date < b2.date
-    LEFT JOIN product_totals AS pt
-        ON
-            b2.account_id = pt.account_id
-            AND b2.product = pt.product
-            AND b2.date = pt.date
-    WHERE pt.ytd_total_product > 0
-    GROUP BY 1, 2, 3
+        account_id,
+        product,
+        date,
+        CASE WHEN last_monthly_date > date THEN last_monthly_date END AS monthly_future_date,
+        CASE WHEN last_ttm_date > date THEN last_ttm_date END AS ttm_future_date,
+        CASE WHEN last_ytd_date > date THEN last_ytd_date END AS ytd_future_date
+    FROM last_positive_dates
 ),
 
 customer_status AS (
@@ -85,8 +69,8 @@ customer_status AS (
         ra.date,
         CASE
             WHEN pt.monthly_total_product > 0 AND pt.monthly_trailing_total_product <= 0 AND DATEDIFF('month', ra.monthly_cohort, ra.date) < 12 THEN 'new'
-            WHEN pt.monthly_total_product <= 0 AND pt.monthly_trailing_total_product > 0 AND m.future_date IS NULL THEN 'lost'
-            WHEN pt.monthly_total_product <= 0 AND pt.monthly_trailing_total_product > 0 AND m.future_date IS NOT NULL THEN 'lapsed'
+            WHEN pt.monthly_total_product <= 0 AND pt.monthly_trailing_total_product > 0 AND fd.monthly_future_date IS NULL THEN 'lost'
+            WHEN pt.monthly_total_product <= 0 AND pt.monthly_trailing_total_product > 0 AND fd.monthly_future_date IS NOT NULL THEN 'lapsed'
             WHEN pt.monthly_total_product > 0 AND pt.monthly_trailing_total_product <= 0 AND DATEDIFF('month', ra.monthly_cohort, ra.date) >= 12 THEN 'recovered'
             WHEN ra.monthly_total > 0 AND pt.monthly_trailing_total_product > 0 AND ra.change_in_existing_monthly >= 0 THEN 'upsell'
             WHEN pt.monthly_total_product > 0 AND ra.monthly_trailing_total > 0 AND ra.change_in_existing_monthly < 0 THEN 'downsell'
@@ -95,8 +79,8 @@ customer_status AS (
         END AS monthly_status,
         CASE
             WHEN pt.ttm_total_product > 0 AND pt.ttm_trailing_total_product <= 0 AND DATEDIFF('month', ra.ttm_cohort, ra.date) < 12 THEN 'new'
-            WHEN pt.ttm_total_product <= 0 AND pt.ttm_trailing_total_product > 0 AND t.future_date IS NULL THEN 'lost'
-            WHEN pt.ttm_total_product <= 0 AND pt.ttm_trailing_total_product > 0 AND t.future_date IS NOT NULL THEN 'lapsed'
+            WHEN pt.ttm_total_product <= 0 AND pt.ttm_trailing_total_product > 0 AND fd.ttm_future_date IS NULL THEN 'lost'
+            WHEN pt.ttm_total_product <= 0 AND pt.ttm_trailing_total_product > 0 AND fd.ttm_future_date IS NOT NULL THEN 'lapsed'
             WHEN pt.ttm_total_product > 0 AND pt.ttm_trailing_total_product <= 0 AND DATEDIFF('month', ra.ttm_cohort, ra.date) >= 12 THEN 'recovered'
             WHEN ra.ttm_total > 0 AND (pt.ttm_trailing_total_product > 0 OR ra.ttm_total_new > 0) AND ra.change_in_existing_ttm >= 0 THEN 'upsell'
             WHEN pt.ttm_total_product > 0 AND (ra.ttm_trailing_total > 0 OR ra.ttm_total_new > 0) AND (ra.change_in_existing_ttm < 0 OR ra.ttm_total <= 0) THEN 'downsell'
@@ -105,35 +89,25 @@ customer_status AS (
         END AS ttm_status,
         CASE
             WHEN pt.ytd_total_product > 0 AND pt.ytd_trailing_total_product <= 0 AND DATEDIFF('month', ra.ytd_cohort, ra.date) < 12 THEN 'new'
-            WHEN pt.ytd_total_product <= 0 AND pt.ytd_trailing_total_product > 0 AND y.future_date IS NULL THEN 'lost'
-            WHEN pt.ytd_total_product <= 0 AND pt.ytd_trailing_total_product > 0 AND y.future_date IS NOT NULL THEN 'lapsed'
+            WHEN pt.ytd_total_product <= 0 AND pt.ytd_trailing_total_product > 0 AND fd.ytd_future_date IS NULL THEN 'lost'
+            WHEN pt.ytd_total_product <= 0 AND pt.ytd_trailing_total_product > 0 AND fd.ytd_future_date IS NOT NULL THEN 'lapsed'
             WHEN pt.ytd_total_product > 0 AND pt.ytd_trailing_total_product <= 0 AND DATEDIFF('month', ra.ytd_cohort, ra.date) >= 12 THEN 'recovered'
             WHEN ra.ytd_total > 0 AND (pt.ytd_trailing_total_product > 0 OR ra.ytd_total_new > 0) AND ra.change_in_existing_ytd >= 0 THEN 'upsell'
             WHEN pt.ytd_total_product > 0 AND (ra.ytd_trailing_total > 0 OR ra.ytd_total_new > 0) AND (ra.change_in_existing_ytd < 0 OR ra.ytd_total <= 0) THEN 'downsell'
             WHEN pt.ytd_total_product <= 0 AND pt.ytd_trailing_total_product <= 0 THEN 'negative or null'
             ELSE 'unknown'
         END AS ytd_status
-    FROM {{ ref('processing_retention_aux') }} AS ra
+    FROM retention_aux AS ra
     LEFT JOIN product_totals AS pt
         ON
             ra.account_id = pt.account_id
             AND ra.product = pt.product
             AND ra.date = pt.date
-    LEFT JOIN monthly_future_total AS m
+    LEFT JOIN future_dates AS fd
         ON
-            ra.account_id = m.account_id
-            AND ra.product = m.product
-            AND ra.date = m.date
-    LEFT JOIN ttm_future_total AS t
-        ON
-            ra.account_id = t.account_id
-            AND ra.product = t.product
-            AND ra.date = t.date
-    LEFT JOIN ytd_future_total AS y
-        ON
-            ra.account_id = y.account_id
-            AND ra.product = y.product
-            AND ra.date = y.date
+            ra.account_id = fd.account_id
+            AND ra.product = fd.product
+            AND ra.date = fd.date
 ),
 
 processing_max_ttm AS (
@@ -151,7 +125,7 @@ processing_max_ttm AS (
             WHEN max_total > 0 THEN '7. Micro ($1 - $10k)'
             ELSE '8. Non Active (<= $0)'
         END AS processing_max_ttm_size
-    FROM {{ ref('processing_retention_aux') }}
+    FROM retention_aux
     GROUP BY 1, 2
 ),
 
@@ -209,8 +183,9 @@ SELECT
     ELSE a.utm_source END, 'unknown') AS attribution_source,
     m.product_max_ttm_size,
     COALESCE(pmax.processing_max_ttm_size, '8. Non Active (<= $0)') AS processing_max_ttm_size,
-    COALESCE(cspy.customer_size_py, '8. Non Active (<= $0)') AS customer_size_py
-FROM {{ ref('processing_retention_aux') }} AS c
+    COALESCE(cspy.customer_size_py, '8. Non Active (<= $0)') AS customer_size_py,
+    c.refreshed_at
+FROM retention_aux AS c
 LEFT JOIN customer_status AS s
     ON
         c.account_id = s.account_id
@@ -1,5 +1,32 @@
 processing_retention_aux.sql
-WITH gateway_group AS (
+{{
+    config(
+        materialized='incremental',
+        unique_key='account_id',
+        incremental_strategy='delete+insert',
+        on_schema_change='append_new_columns'
+    )
+}}
+
+-- Incremental runs rebuild the full history of the accounts with transactions in the last
+-- retention_lookback_months months before the latest loaded month. Those are the accounts whose
+-- month grid, TTM/YTD windows or cohorts can change (account_dates extends 24 months past the last
+-- transaction). Run with --full-refresh to rebuild every account, e.g. after backfilling old rates.
+-- Rows built before refreshed_at existed keep it empty until their account is rebuilt.
+WITH
+{% if is_incremental() %}
+changed_accounts AS (
+    SELECT DISTINCT account_id
+    FROM {{ ref('dim_transaction') }}
+    WHERE
+        status = 6
+        AND date_created >= DATEADD(
+            'month', -{{ var('retention_lookback_months', 24) }}, (SELECT MAX(date) FROM {{ this }})
+        )
+),
+{% endif %}
+
+gateway_group AS (
     SELECT
         type,
         CASE
@@ -41,16 +68,20 @@ temp AS (
         ON t.account_id = ama.account_id
     LEFT JOIN {{ ref('dim_account_managers') }} AS am
         ON ama.account_manager_id = am.id
-    LEFT JOIN {{ source('wbx_data', 'exchange_rates') }} AS er
+    LEFT JOIN {{ source('wbx_data', 'exchange_rates_daily') }} AS er
         ON
             t.currency = er.currency
-            AND DATE_TRUNC('day', t.date_created)::date = er.date
+            AND DATEDIFF('day', '1970-01-01', t.date_created) = er.day_key -- day_key is the Unix day number
     LEFT JOIN {{ source('wbx_data', 'take_rates') }} AS tr
         ON
             gg.gateway_group = tr.gateway_group
             AND DATE_TRUNC('month', t.date_created)::date = tr.date
             AND f.product = tr.product
-    WHERE t.status = 6
+    WHERE
+        t.status = 6
+        {% if is_incremental() %}
+            AND t.account_id IN (SELECT account_id FROM changed_accounts)
+        {% endif %}
     GROUP BY 1, 2, 3, 4, 5, 6, 7
 ),
 
@@ -129,22 +160,38 @@ base AS (
             AND a.gateway_group = t.gateway_group
 ),
 
+-- One row per account/product/gateway and month. The months of each combination are contiguous
+-- (account_dates spans every month between its bounds), so the ROWS frames below count months.
+-- row_count is the number of base rows sharing the id; totals are scaled by it so they match a
+-- sum over every base row of the id.
+base_monthly AS (
+    SELECT
+        id,
+        account_id,
+        product,
+        gateway_group,
+        date,
+        year,
+        month,
+        COUNT(*) AS row_count,
+        SUM(monthly_total) AS monthly_total,
+        SUM(monthly_total::decimal(15, 3)) AS monthly_total_rounded
+    FROM base
+    GROUP BY 1, 2, 3, 4, 5, 6, 7
+),
+
 monthly_trailing_total AS (
     SELECT
-        b1.id,
-        b1.account_id,
-        b1.product,
-        b1.gateway_group,
-        b1.date,
-        COALESCE(SUM(b2.monthly_total::decimal(15, 3)), 0) AS monthly_trailing_total
-    FROM base AS b1
-    LEFT JOIN base AS b2
-        ON
-            b1.account_id = b2.account_id
-            AND b1.product = b2.product
-            AND b1.gateway_group = b2.gateway_group
-            AND b2.date = DATEADD('year', -1, b1.date)
-    GROUP BY 1, 2, 3, 4, 5
+        id,
+        account_id,
+        product,
+        gateway_group,
+        date,
+        COALESCE(row_count * LAG(monthly_total_rounded, 12) OVER (
+            PARTITION BY account_id, product, gateway_group
+            ORDER BY date
+        ), 0) AS monthly_trailing_total
+    FROM base_monthly
 ),
 
 ---------------------------------------- TTM ----------------------------------------
@@ -181,23 +228,22 @@ ttm_trailing_total AS (
     FROM ttm_total AS ttm
 ),
 
+-- Sum of the months after the 11 preceding ones that fall in the first 12 months of the cohort
 ttm_monthly_aggregate AS (
     SELECT
         b.id,
-        SUM(b2.monthly_total) AS monthly_aggregate
-    FROM base AS b
+        b.row_count * SUM(
+            CASE WHEN b.date < DATEADD('month', 12, ttmc.ttm_cohort) THEN b.monthly_total END
+        ) OVER (
+            PARTITION BY b.account_id, b.product, b.gateway_group
+            ORDER BY b.date
+            ROWS BETWEEN 11 PRECEDING AND UNBOUNDED FOLLOWING
+        ) AS monthly_aggregate
+    FROM base_monthly AS b
     LEFT JOIN ttm_cohort AS ttmc
         ON
             b.account_id = ttmc.account_id
             AND b.product = ttmc.product
-    LEFT JOIN base AS b2
-        ON
-            b.account_id = b2.account_id
-            AND b.product = b2.product
-            AND b.gateway_group = b2.gateway_group
-            AND b2.date < DATEADD('month', 12, ttmc.ttm_cohort)
-            AND b2.date > DATEADD('month', -12, b.date)
-    GROUP BY 1
 ),
 
 ttm_total_new_existing AS (
@@ -229,21 +275,17 @@ ttm_total_new_existing AS (
 ---------------------------------------- YTD ----------------------------------------
 ytd_total AS (
     SELECT
-        b1.id,
-        b1.account_id,
-        b1.product,
-        b1.gateway_group,
-        b1.date,
-        COALESCE(SUM(b2.monthly_total::decimal(15, 3)), 0) AS ytd_total
-    FROM base AS b1
-    LEFT JOIN base AS b2
-        ON
-            b1.account_id = b2.account_id
-            AND b1.product = b2.product
-            AND b1.gateway_group = b2.gateway_group
-            AND b1.month >= b2.month
-            AND b1.year = b2.year
-    GROUP BY 1, 2, 3, 4, 5
+        id,
+        account_id,
+        product,
+        gateway_group,
+        date,
+        COALESCE(row_count * SUM(monthly_total_rounded) OVER (
+            PARTITION BY account_id, product, gateway_group, year
+            ORDER BY month
+            ROWS UNBOUNDED PRECEDING
+        ), 0) AS ytd_total
+    FROM base_monthly
 ),
 
 ytd_cohort AS (
@@ -263,24 +305,27 @@ ytd_trailing_total AS (
     FROM ytd_total AS ytd
 ),
 
+-- Same as ttm_monthly_aggregate, restricted to the calendar year after the cohort year
 ytd_monthly_aggregate AS (
     SELECT
         b.id,
-        SUM(b2.monthly_total) AS monthly_aggregate
-    FROM base AS b
+        b.row_count * SUM(
+            CASE
+                WHEN
+                    b.date < DATEADD('month', 12, ytdc.ytd_cohort)
+                    AND DATE_PART(YEAR, b.date) = DATE_PART(YEAR, ytdc.ytd_cohort) + 1
+                    THEN b.monthly_total
+            END
+        ) OVER (
+            PARTITION BY b.account_id, b.product, b.gateway_group
+            ORDER BY b.date
+            ROWS BETWEEN 11 PRECEDING AND UNBOUNDED FOLLOWING
+        ) AS monthly_aggregate
+    FROM base_monthly AS b
     LEFT JOIN ytd_cohort AS ytdc
         ON
             b.account_id = ytdc.account_id
             AND b.product = ytdc.product
-    LEFT JOIN base AS b2
-        ON
-            b.account_id = b2.account_id
-            AND b.product = b2.product
-            AND b.gateway_group = b2.gateway_group
-            AND b2.date < DATEADD('month', 12, ytdc.ytd_cohort)
-            AND b2.date > DATEADD('month', -12, b.date)
-            AND DATE_PART(YEAR, b2.date) = DATE_PART(YEAR, ytdc.ytd_cohort) + 1
-    GROUP BY 1
 ),
 
 ytd_total_new_existing AS (
@@ -337,7 +382,8 @@ SELECT
     COALESCE(ytne.ytd_total_new, 0) AS ytd_total_new,
     COALESCE(ytne.ytd_total_existing, 0) AS ytd_total_existing,
     COALESCE(ytt.ytd_trailing_total, 0) AS ytd_trailing_total,
-    COALESCE(ytne.ytd_total_existing, 0) - COALESCE(ytt.ytd_trailing_total, 0) AS change_in_existing_ytd
+    COALESCE(ytne.ytd_total_existing, 0) - COALESCE(ytt.ytd_trailing_total, 0) AS change_in_existing_ytd,
+    GETDATE() AS refreshed_at
 FROM base AS b
 LEFT JOIN monthly_trailing_total AS mtt
     ON b.id = mtt.id
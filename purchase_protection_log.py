@@ -1,168 +1,573 @@
-from utils import get_secret, get_rs_conn, get_mysql_client, get_session, get_logger, get_webhook, send_slack_notification
+from utils import get_rs_conn, get_mysql_client, get_logger, send_slack_notification
+from resources import get_secret, get_session, get_webhook
+import pyarrow.parquet as pq
+import pyarrow.csv as pcsv
+import pyarrow.compute as pc
+import pyarrow as pa
 import multiprocessing as mp
+import pymysql
+import tempfile
+import metrics
+import json
+import time
 import os
 
+CHUNK_SIZE = int(os.getenv('PP_CHUNK_SIZE', 100000))   # target rows per exported chunk
+POOL_SIZE = int(os.getenv('PP_POOL_SIZE', 5))
+MAX_ATTEMPTS = int(os.getenv('PP_MAX_ATTEMPTS', 3))    # tries per chunk before the rebuild gives up
+RETRY_BACKOFF = float(os.getenv('PP_RETRY_BACKOFF', 30))  # seconds, doubled on every retry
+FULL_REBUILD = os.getenv('PP_FULL_REBUILD', '0') == '1'  # rebuild even if the table has rows
+EXPORT_FORMAT = os.getenv('PP_EXPORT_FORMAT', 'csv')     # csv, csv.gz, csv.zst or parquet
+FETCH_ROWS = int(os.getenv('PP_FETCH_ROWS', 50000))      # rows per batch when streaming an export
+PP_DETECTION = os.getenv('PP_DETECTION', 'sql')       # sql (LIKE in MySQL) or python (client-side check)
+PP_MARKER = 'purchaseProtection'
+INCREMENTAL_MODE = os.getenv('PP_INCREMENTAL_MODE', 'append')  # append (id > max id) or cdc (date_updated watermark)
+
+# Schema of the exported rows; integer widths match the pp_forms_log columns for Parquet COPY
+SCHEMA = pa.schema([
+    ('id', pa.int32()),
+    ('form_id', pa.int32()),
+    ('pp_enabled', pa.int32()),
+    ('date_created', pa.timestamp('us'))
+])
+
+# Redshift COPY options for each export format
+COPY_FORMATS = {
+    'csv': "CSV IGNOREHEADER 1 DELIMITER ','",
+    'csv.gz': "CSV GZIP IGNOREHEADER 1 DELIMITER ','",
+    'csv.zst': "CSV ZSTD IGNOREHEADER 1 DELIMITER ','",
+    'parquet': "FORMAT AS PARQUET"
+}
+
+creds = {'db': 'wbx_data', 'region': 'us-west-2', 'cluster_id': 'wbx-data'}
+bucket = 'wbx-data.redshift-unload'
+table_name = 'pp_forms_log'
+table_name_full = f"{creds['db']}.{table_name}"
+
+mydb = None  # MySQL connection of the current process, see get_connection
+
 # -------------------------------------- Functions --------------------------------------
 
-# Function to initialize global logger and session for each worker process.
+# Function to initialize global logger and session for each worker process. The MySQL connection
+# is opened by the first chunk the worker handles and reused for the following ones; opening it
+# here would make a failed connect kill the worker, which the pool respawns without end.
 def init_globals():
-    global logger, session
+    global logger, session, mydb
     logger = get_logger()
     session = get_session(creds)
+    mydb = None
+
+
+# Function to return the MySQL connection of the current process and the seconds spent
+# connecting. The cached connection is health-checked and reopened if it has dropped, so the
+# parent and each worker pay connection setup and TLS once rather than per query.
+def get_connection():
+    global mydb
+    if mydb is not None:
+        try:
+            mycursor = mydb.cursor()
+            mycursor.execute("select 1")
+            mycursor.fetchall()
+            mycursor.close()
+            return mydb, 0.0
+        except Exception as e:
+            logger.warning(f"MySQL connection lost, reconnecting: {e}")
+            close_connection()
+
+    started = time.monotonic()
+    mydb = get_mysql_client(session, creds)
+    connect_time = time.monotonic() - started
+    logger.info(f"Opened MySQL connection in {connect_time:.2f}s.")
+    return mydb, connect_time
+
+
+def close_connection():
+    global mydb
+    if mydb is not None:
+        try:
+            mydb.close()
+        except Exception:
+            pass
+        mydb = None
+
+
+# Function to build the select exporting pp_forms_log rows from published_version. With
+# detect set, the form document is returned as is and the purchase protection flag is
+# computed on the client instead of with a leading-wildcard LIKE in MySQL.
+def select_query(where, detect):
+    if detect:
+        pp_enabled = "form"
+    else:
+        pp_enabled = f"case when form LIKE '%{PP_MARKER}%' then 1 else 0 end as pp_enabled"
 
-
-# Task for the multiprocessing pool that will fetch the data in chunks
-# from the published_version table and upload it to S3.
-def task(c, creds, bucket, table_name, chunk):
-    global session, logger  # Access global session and logger
-    logger.info(f'Uploading chunk {c} ...')
-
-    key = f'{table_name}_{c + 1}.csv'
-
-    sql_q = f"""
+    return f"""
     select
         id,
         form_id,
-        case when form LIKE '%purchaseProtection%' then 1 else 0 end as pp_enabled,
+        {pp_enabled},
         date_created
     FROM published_version
-    WHERE id >= {chunk * c} AND id < {chunk * (c + 1)}
-    INTO OUTFILE S3 's3://{bucket}/raw/{table_name}/{key}'
+    WHERE {where}"""
+
+
+# Function to stream the rows of an executed query into a local file in the given format.
+# Aurora's INTO OUTFILE S3 only writes plain text, so compressed, Parquet and client-side
+# detection exports go through the client in batches of FETCH_ROWS. With detect set the
+# third column holds the form document and is reduced to the pp_enabled flag per batch.
+def write_batches(cursor, path, fmt, detect):
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(path, SCHEMA, compression='zstd')
+        sink = None
+    else:
+        sink = pa.OSFile(path, 'wb') if fmt == 'csv' else pa.CompressedOutputStream(path, 'gzip' if fmt == 'csv.gz' else 'zstd')
+        writer = pcsv.CSVWriter(sink, SCHEMA)
+
+    rows = 0
+    while True:
+        batch = cursor.fetchmany(FETCH_ROWS)
+        if not batch:
+            break
+        columns = list(zip(*batch))
+        if detect:
+            forms = pa.array(columns[2])
+            if pa.types.is_binary(forms.type):
+                forms = forms.cast(pa.string())
+            # LIKE is case-insensitive under the default _ci collations, so the match is too
+            found = pc.match_substring(forms, PP_MARKER, ignore_case=True)
+            columns[2] = pc.cast(pc.fill_null(found, False), pa.int32())
+        columns = [col if isinstance(col, pa.Array) else pa.array(col, type=field.type)
+                   for col, field in zip(columns, SCHEMA)]
+        writer.write_table(pa.Table.from_arrays(columns, schema=SCHEMA))
+        rows += len(batch)
+
+    writer.close()
+    if sink is not None:
+        sink.close()
+    return rows
+
+
+# Function to list the objects INTO OUTFILE S3 wrote for key. Aurora treats the URI as a prefix
+# and writes <key>.part_00000, <key>.part_00001, ... so nothing exists at key itself.
+def list_parts(bucket, key):
+    paginator = session.client('s3').get_paginator('list_objects_v2')
+    return [{'key': obj['Key'], 'bytes': obj['Size']}
+            for page in paginator.paginate(Bucket=bucket, Prefix=f'{key}.part_')
+            for obj in page.get('Contents', [])]
+
+
+# Function to export the rows matching a where clause on published_version to S3 in the given
+# format. Returns the number of rows and the S3 objects written, as a list of {'key', 'bytes'}.
+def export_query(mydb, where, bucket, key, fmt):
+    detect = PP_DETECTION == 'python'
+    query = select_query(where, detect)
+
+    if fmt == 'csv' and not detect:
+        # A previous export may have written more parts than this one will overwrite
+        stale = list_parts(bucket, key)
+        for i in range(0, len(stale), 1000):
+            session.client('s3').delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': p['key']} for p in stale[i:i + 1000]]})
+
+        mycursor = mydb.cursor()
+        mycursor.execute(f"""{query}
+    INTO OUTFILE S3 's3://{bucket}/{key}'
     FORMAT CSV HEADER
     OVERWRITE ON;
-    """
-
-    mydb = get_mysql_client(session, creds)
-    mycursor = mydb.cursor()
-    mycursor.execute(sql_q)
+    """)
+        rows = mycursor.rowcount
+        parts = list_parts(bucket, key)
+    else:
+        # A server-side cursor, so rows are streamed from the server instead of buffered in memory
+        mycursor = mydb.cursor(pymysql.cursors.SSCursor)
+        mycursor.execute(query)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, os.path.basename(key))
+            rows = write_batches(mycursor, path, fmt, detect)
+            session.client('s3').upload_file(path, bucket, key)
+            parts = [{'key': key, 'bytes': os.path.getsize(path)}]
 
     mycursor.close()
-    mydb.close()
+    return rows, parts
 
-    logger.info(f'Chunk {c} uploaded.')
 
-
-# Function to build the pp_forms_log table if empty
-def build_new_pp_forms_log_table():
+# Task for the multiprocessing pool that will fetch the data in chunks
+# from the published_version table and upload it to S3.
+def task(c, creds, bucket, table_name, start, end, fmt):
     global session, logger  # Access global session and logger
+    logger.info(f'Uploading chunk {c} (ids {start} to {end - 1}) ...')
+    started = time.monotonic()
+
+    key = f'{table_name}_{c + 1}.{fmt}'
+
+    mydb, connect_time = get_connection()
+    rows, parts = export_query(mydb, f'id >= {start} AND id < {end}', bucket, f'raw/{table_name}/{key}', fmt)
+    size = sum(p['bytes'] for p in parts)
+
+    elapsed = time.monotonic() - started
+    logger.info(f'Chunk {c} uploaded: {rows} rows, {size} bytes in {len(parts)} files in {elapsed:.1f}s '
+                f'({connect_time:.2f}s connecting, {elapsed - connect_time:.1f}s querying).')
+    return c, parts, rows, size, elapsed, connect_time
+
+
+# Function to split published_version into id ranges holding chunk_size rows each. The range
+# boundaries are the ids at every chunk_size-th row, so sparse ids or ids starting high still
+# give balanced chunks. Returns a list of (start, end, rows) with end exclusive.
+def plan_chunks(cursor, chunk_size):
+    cursor.execute("select min(id), max(id), count(*) from published_version")
+    min_id, max_id, total = cursor.fetchall()[0]
+    if not total:
+        return []
+
+    cursor.execute(f"""
+    select id
+    from (
+        select id, row_number() over (order by id) as rn
+        from published_version
+    ) as t
+    where (rn - 1) % {chunk_size} = 0
+    order by id
+    """)
+    starts = [r[0] for r in cursor.fetchall()]
+    ends = starts[1:] + [max_id + 1]
+    rows = [chunk_size] * (len(starts) - 1) + [total - chunk_size * (len(starts) - 1)]
+
+    logger.info(f"Total records: {total} with ids {min_id} to {max_id}, planned {len(starts)} chunks.")
+    return list(zip(starts, ends, rows))
+
+
+# Task wrapper retrying a chunk with exponential backoff.
+# Returns (c, parts, rows, size, elapsed, connect_time, error).
+def run_chunk(args):
+    c = args[0]
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return task(*args) + (None,)
+        except Exception as e:
+            logger.warning(f'Chunk {c} failed (attempt {attempt} of {MAX_ATTEMPTS}): {e}')
+            if attempt == MAX_ATTEMPTS:
+                return c, None, 0, 0, 0, 0, str(e)
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+
+# Functions to read and write the JSON state files kept next to the exports: the checkpoint
+# ledger of the current rebuild (the chunk plan and every chunk exported so far with the S3
+# objects it wrote, id range and row count) and the date_updated watermark of the CDC mode.
+def read_state(name):
+    s3 = session.client('s3')
+    try:
+        body = s3.get_object(Bucket=bucket, Key=f'raw/{table_name}/{name}')['Body'].read()
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(body)
 
-    mydb = get_mysql_client(session, creds)
-    mycursor = mydb.cursor()
-    mycursor.execute(f"select count(*) from published_version")
 
-    l = mycursor.fetchall()[0][0]
-    logger.info(f"Total records: {l}")
+def write_state(name, data):
+    session.client('s3').put_object(Bucket=bucket, Key=f'raw/{table_name}/{name}', Body=json.dumps(data))
 
-    mycursor.close()
-    mydb.close()
 
-    chunk = 100000
-    chunks = range(int(l / chunk) + 1)
+def delete_state(name):
+    session.client('s3').delete_object(Bucket=bucket, Key=f'raw/{table_name}/{name}')
+
+
+# Function to fetch the latest date_updated in published_version, used as the CDC watermark.
+# Returns None when no row has a date_updated.
+def get_update_watermark(mycursor):
+    mycursor.execute("select max(date_updated) from published_version")
+    watermark = mycursor.fetchall()[0][0]
+    return None if watermark is None else str(watermark)
+
 
-    # Initialize a pool of processes
-    pool = mp.Pool(5, initializer=init_globals)  # Set initializer to init_globals
-    pool.starmap(task, [(c, creds, bucket, table_name, chunk) for c in chunks])
-    pool.close()
-    pool.join()  # Ensure all processes finish
+def ledger_complete(ledger):
+    return len(ledger['done']) == len(ledger['chunks'])
 
 
-# Function to copy chunks from S3 to the pp_forms_log table
-def copy_chunks_to_table():
+# Function to list the S3 objects of every exported chunk in chunk order
+def ledger_parts(ledger):
+    parts = []
+    for _, d in sorted(ledger['done'].items(), key=lambda x: int(x[0])):
+        parts += d['parts']
+    return parts
+
+
+# Function to build the pp_forms_log table if empty. A rebuild that died part way resumes from
+# its ledger: finished chunks are skipped and only the missing ones are exported again.
+def build_new_pp_forms_log_table():
+    global session, logger  # Access global session and logger
+
+    ledger = read_state('_ledger.json')
+    if ledger is None:
+        # The watermark is taken before planning so updates made during the export are
+        # picked up by the next CDC run
+        with metrics.span('plan'):
+            mydb, _ = get_connection()
+            mycursor = mydb.cursor()
+            watermark = get_update_watermark(mycursor)
+            chunks = plan_chunks(mycursor, CHUNK_SIZE)
+            mycursor.close()
+
+        ledger = {'chunks': chunks, 'format': EXPORT_FORMAT, 'watermark': watermark, 'done': {}}
+        write_state('_ledger.json', ledger)
+    else:
+        logger.info(f"Resuming rebuild: {len(ledger['done'])} of {len(ledger['chunks'])} chunks already exported.")
+
+    # A resumed rebuild keeps the format it was started with
+    chunks = ledger['chunks']
+    fmt = ledger.get('format', 'csv')
+    todo = [(c, creds, bucket, table_name, start, end, fmt) for c, (start, end, _) in enumerate(chunks)
+            if str(c) not in ledger['done']]
+
+    # Forked workers must not share the parent's socket, so it is closed before the pool starts
+    close_connection()
+
+    # Initialize a pool of processes. Every finished chunk is checkpointed as soon as it completes.
+    results = []
+    failed = []
+    with metrics.span('export'), mp.Pool(POOL_SIZE, initializer=init_globals) as pool:  # Set initializer to init_globals
+        for c, parts, rows, size, elapsed, connect_time, error in pool.imap_unordered(run_chunk, todo):
+            if error is not None:
+                failed.append(c)
+                metrics.count('failed_chunks')
+                continue
+            start, end, _ = chunks[c]
+            ledger['done'][str(c)] = {'parts': parts, 'start': start, 'end': end, 'rows': rows, 'bytes': size}
+            write_state('_ledger.json', ledger)
+            results.append((c, rows, size, elapsed, connect_time))
+
+            # Chunks are timed in the workers, so their spans are recorded from the results
+            metrics.record('chunk', elapsed)
+            metrics.record('chunk_connect', connect_time)
+            metrics.count('rows', rows)
+            metrics.count('bytes', size)
+
+    # Report how the actual chunks compare with the plan
+    for c, rows, size, elapsed, connect_time in sorted(results):
+        start, end, planned = chunks[c]
+        logger.info(f"Chunk {c}: ids {start} to {end - 1}, {rows} rows (planned {planned}), {size} bytes, {elapsed:.1f}s")
+    logger.info(f"Exported {sum(r[1] for r in results)} rows and {sum(r[2] for r in results)} bytes as {fmt} "
+                f"in {len(results)} chunks, slowest chunk {max((r[3] for r in results), default=0):.1f}s.")
+    logger.info(f"Time spent connecting: {sum(r[4] for r in results):.1f}s, "
+                f"querying: {sum(r[3] - r[4] for r in results):.1f}s.")
+    if failed:
+        logger.error(f"Chunks {sorted(failed)} failed after {MAX_ATTEMPTS} attempts.")
+
+    return ledger
+
+
+# Function to write a COPY manifest listing exactly the given S3 objects, as returned by export_query
+def write_manifest(name, parts):
+    # Parquet COPY needs the size of every file in the manifest
+    entries = [{'url': f"s3://{bucket}/{p['key']}", 'mandatory': True, 'meta': {'content_length': p['bytes']}}
+               for p in parts]
+    manifest_key = f'raw/{table_name}/{name}'
+    session.client('s3').put_object(Bucket=bucket, Key=manifest_key, Body=json.dumps({'entries': entries}))
+    return f's3://{bucket}/{manifest_key}'
+
+
+# Function to check whether a table exists in the target schema
+def table_exists(name):
+    rscursor.execute(f"""
+    select count(*)
+    from information_schema.tables
+    where table_schema = '{creds['db']}'
+        and table_name = '{name}';
+    """)
+    return rscursor.fetchall()[0][0] > 0
+
+
+# Function to copy chunks from S3 to the pp_forms_log table. The chunks are loaded into a staging
+# table, checked against the ledger row counts and then swapped in, so readers keep seeing the
+# previous rows for the whole COPY.
+def copy_chunks_to_table(ledger):
     global conn, rscursor  # Ensure conn and rscursor are accessible
 
-    rscursor.execute(f"DROP TABLE IF EXISTS {table_name_full} CASCADE;")
-    conn.commit()
+    staging = f'{table_name}_staging'
+    staging_full = f"{creds['db']}.{staging}"
 
-    rscursor.execute(f'CREATE TABLE {table_name_full} ("id" integer, "form_id" integer, "pp_enabled" integer, "date_created" timestamp);')
+    rscursor.execute(f"DROP TABLE IF EXISTS {staging_full};")
     conn.commit()
 
-    rscursor.execute(f"GRANT ALL PRIVILEGES ON TABLE wbx_data.pp_forms_log TO GROUP admin;;")
+    rscursor.execute(f'CREATE TABLE {staging_full} ("id" integer, "form_id" integer, "pp_enabled" integer, "date_created" timestamp);')
     conn.commit()
 
 
-    s3_file_path = f's3://{bucket}/raw/{table_name}'
+    s3_file_path = write_manifest('_manifest.json', ledger_parts(ledger))
 
     copy_query = f"""
-        COPY {table_name_full}
+        COPY {staging_full}
         FROM '{s3_file_path}'
         IAM_ROLE '{iam_role}'
-        CSV
-        IGNOREHEADER 1
-        DELIMITER ',';
+        MANIFEST
+        {COPY_FORMATS[ledger.get('format', 'csv')]};
     """
 
-    rscursor.execute(copy_query)
-    conn.commit()
+    with metrics.span('copy'):
+        rscursor.execute(copy_query)
+        conn.commit()
+
+    # Verify the staging table against the row counts recorded for each exported chunk. An export
+    # through INTO OUTFILE S3 may report -1 rows; those chunks are left out and only the id ranges
+    # of the chunks with a known count are checked.
+    known = [d for d in ledger['done'].values() if d['rows'] >= 0]
+    expected = sum(d['rows'] for d in known)
+    ranges = ' OR '.join(f"(id >= {d['start']} AND id < {d['end']})" for d in known) or 'false'
+    with metrics.span('verify'):
+        loaded, checked = rscursor.execute(
+            f"select count(*), coalesce(sum(case when {ranges} then 1 else 0 end), 0) from {staging_full}").fetchall()[0]
+    if checked != expected:
+        raise RuntimeError(f"{staging_full} has {checked} rows in the checked chunks, ledger expects {expected}.")
+    if len(known) < len(ledger['done']):
+        logger.warning(f"Row count only checked for {len(known)} of {len(ledger['done'])} chunks, "
+                       f"the others reported no row count.")
+    logger.info(f"Loaded {loaded} rows into {staging_full}.")
+
+    # Swap the rows in within one transaction. Schema-bound views follow a renamed table, so the
+    # live table is kept and only its contents are replaced; a first build renames staging in.
+    columns = 'id, form_id, pp_enabled, date_created'
+    with metrics.span('swap'):
+        if table_exists(table_name):
+            rscursor.execute(f"DELETE FROM {table_name_full};")
+            rscursor.execute(f"INSERT INTO {table_name_full} ({columns}) SELECT {columns} FROM {staging_full};")
+        else:
+            rscursor.execute(f"ALTER TABLE {staging_full} RENAME TO {table_name};")
+        rscursor.execute(f"GRANT ALL PRIVILEGES ON TABLE {table_name_full} TO GROUP admin;")
+        conn.commit()
+
+    with metrics.span('grants'):
+        rscursor.execute(f"GRANT ALL ON ALL TABLES IN SCHEMA {creds['db']} TO GROUP admin;")
+        conn.commit()
+
+    # Nothing should depend on the staging table; if it cannot be dropped the next rebuild would fail
+    try:
+        rscursor.execute(f"DROP TABLE IF EXISTS {staging_full};")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        send_slack_notification(webhook_url, f":red-x-mark: Could not drop {staging_full} after the pp form logs rebuild: {e}")
+        raise
 
 
 # Function to add new records from published_version to pp_forms_log
 def add_new_records():
     global session, logger  # Access global session and logger
 
-    new_file = 'new_pp_form_records.csv'
+    new_file = f'new_pp_form_records.{EXPORT_FORMAT}'
 
-    new_records = f"""
-    select
-        id,
-        form_id,
-        case when form LIKE '%purchaseProtection%' then 1 else 0 end as pp_enabled,
-        date_created
-    FROM published_version
-    WHERE id > {max_id}
-    INTO OUTFILE S3 's3://{bucket}/raw/{table_name}/{new_file}'
-    FORMAT CSV HEADER
-    OVERWRITE ON;
+    with metrics.span('connect_mysql'):
+        mydb, _ = get_connection()
+    with metrics.span('export'):
+        rows, parts = export_query(mydb, f'id > {max_id}', bucket, f'raw/{table_name}/{new_file}', EXPORT_FORMAT)
+    size = sum(p['bytes'] for p in parts)
+    metrics.count('rows', rows)
+    metrics.count('bytes', size)
+
+    if not parts:
+        logger.info("No new records.")
+        return
+    logger.info(f"Adding {rows} new records ({size} bytes) to table ...")
+
+    s3_file_path = write_manifest('_new_manifest.json', parts)
+
+    copy_query = f"""
+        COPY {table_name_full}
+        FROM '{s3_file_path}'
+        IAM_ROLE '{iam_role}'
+        MANIFEST
+        {COPY_FORMATS[EXPORT_FORMAT]};
     """
 
-    mydb = get_mysql_client(session, creds)
-    mycursor = mydb.cursor()
-    mycursor.execute(new_records)
+    with metrics.span('copy'):
+        rscursor.execute(copy_query)
+        conn.commit()
+
+# Function to apply inserts and updates from published_version to pp_forms_log. Rows updated
+# since the saved date_updated watermark, and rows above the current max id, are exported,
+# copied into a temporary staging table and merged into the table by id. The lower bound is
+# inclusive: rows updated in the second of the last watermark after it was read are only picked
+# up this way, and rows exported twice are replaced by id.
+def merge_changed_records():
+    global session, logger  # Access global session and logger
 
+    with metrics.span('connect_mysql'):
+        mydb, _ = get_connection()
+    mycursor = mydb.cursor()
+    upper = get_update_watermark(mycursor)
     mycursor.close()
-    mydb.close()
 
-    logger.info("Adding new records to table ...")
+    if upper is None:
+        logger.info("No row of published_version has a date_updated, adding new records only.")
+        add_new_records()
+        return
 
-    s3_file_path = f's3://{bucket}/raw/{table_name}/{new_file}'
+    state = read_state('_cdc_state.json')
+    if state is None:
+        # Without a watermark only new ids can be picked up; the next run merges updates
+        logger.info(f"No CDC watermark yet, starting from {upper}.")
+        add_new_records()
+        write_state('_cdc_state.json', {'watermark': upper})
+        return
+
+    lower = state['watermark']
+    where = f"(date_updated >= '{lower}' AND date_updated <= '{upper}') OR id > {max_id}"
+    changes_file = f'changed_pp_form_records.{EXPORT_FORMAT}'
+    with metrics.span('export'):
+        rows, parts = export_query(mydb, where, bucket, f'raw/{table_name}/{changes_file}', EXPORT_FORMAT)
+    size = sum(p['bytes'] for p in parts)
+    metrics.count('rows', rows)
+    metrics.count('bytes', size)
+
+    if not parts:
+        logger.info(f"No records changed since {lower}.")
+        write_state('_cdc_state.json', {'watermark': upper})
+        return
+    logger.info(f"Merging {rows} changed records ({size} bytes) updated since {lower} ...")
+
+    staging = f'{table_name}_changes'
+    rscursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {table_name_full});")
 
     copy_query = f"""
-        COPY {table_name_full}
-        FROM '{s3_file_path}'
+        COPY {staging}
+        FROM '{write_manifest('_changes_manifest.json', parts)}'
         IAM_ROLE '{iam_role}'
-        CSV
-        IGNOREHEADER 1
-        DELIMITER ',';
+        MANIFEST
+        {COPY_FORMATS[EXPORT_FORMAT]};
     """
+    with metrics.span('copy'):
+        rscursor.execute(copy_query)
 
-    rscursor.execute(copy_query)
-    conn.commit()
+    with metrics.span('merge'):
+        rscursor.execute(f"DELETE FROM {table_name_full} USING {staging} WHERE {table_name_full}.id = {staging}.id;")
+        rscursor.execute(f"INSERT INTO {table_name_full} SELECT * FROM {staging};")
+        rscursor.execute(f"DROP TABLE {staging};")
+        conn.commit()
+
+    write_state('_cdc_state.json', {'watermark': upper})
 
 # -------------------------------------- Start --------------------------------------
 
-if __name__ == "__main__":
+def main():
+    global logger, session, conn, rscursor, iam_role, max_id, webhook_url
+    metrics.start_run('purchase_protection_log')
     logger = get_logger()
     logger.info("Starting ...")
 
-    creds = {'db': 'wbx_data', 'region': 'us-west-2', 'cluster_id': 'wbx-data'}
-
     # Defining variables
     iam_role = f"arn:aws:iam::{os.environ['ACCOUNT_ID']}:role/redshift-unload"
-    bucket = 'wbx-data.redshift-unload'
-    table_name = 'pp_forms_log'
-    table_name_full = f"{creds['db']}.{table_name}"
 
     # Initializing Botocore client
     logger.info("Initializing Botocore client ...")
-    session = get_session(creds)
+    with metrics.span('session'):
+        session = get_session(creds)
 
     # Setting up Webhook
-    webhook_url = get_webhook(session, creds)
+    with metrics.span('secrets'):
+        webhook_url = get_webhook(session, creds)
     send_slack_notification(webhook_url, "Updating pp form logs :loading_dots:")
 
     # Establishing Redshift connection
     logger.info("Establishing Redshift connection ...")
-    rs_secret = get_secret(os.environ['RS_SECRET'], session, creds['region'])
-    conn = get_rs_conn(rs_secret)
+    with metrics.span('secrets'):
+        rs_secret = get_secret(os.environ['RS_SECRET'], session, creds['region'])
+    with metrics.span('connect'):
+        conn = get_rs_conn(rs_secret)
     rscursor = conn.cursor()
 
     # Check if the pp_forms_log table exists and has records by fetching the max id
@@ -172,18 +577,40 @@ if __name__ == "__main__":
     except:
         max_id = 0
 
-    # If the pp_forms_log table is empty, populate it
-    if max_id == 0 or max_id is None:
-        logger.info(f'{table_name} table is empty. Populating ...')
-        build_new_pp_forms_log_table()
-        
+    # If the pp_forms_log table is empty or a rebuild was requested, populate it
+    if max_id == 0 or max_id is None or FULL_REBUILD:
+        logger.info(f'Rebuilding {table_name} table ...')
+        with metrics.span('rebuild'):
+            ledger = build_new_pp_forms_log_table()
+
+        # Only load once every chunk is exported; a rerun resumes from the ledger
+        if not ledger_complete(ledger):
+            metrics.finish('incomplete')
+            send_slack_notification(webhook_url, ":red-x-mark: PP form logs rebuild incomplete, rerun to resume.")
+            raise SystemExit(1)
+
         logger.info(f'Copying chunks to table...')
-        copy_chunks_to_table()
+        with metrics.span('load'):
+            copy_chunks_to_table(ledger)
+        if ledger.get('watermark') is not None:
+            write_state('_cdc_state.json', {'watermark': ledger['watermark']})
+        delete_state('_ledger.json')
 
     # Otherwise, fetch and add new records from the published_version table   
+    elif INCREMENTAL_MODE == 'cdc':
+        logger.info("Fetching changed records ...")
+        with metrics.span('cdc'):
+            merge_changed_records()
+
     else:
         logger.info("Fetching new records ...")
-        add_new_records()
+        with metrics.span('append'):
+            add_new_records()
 
-    send_slack_notification(webhook_url, "PP form logs updated :white_check_mark:")
+    close_connection()
+    send_slack_notification(webhook_url, f"PP form logs updated :white_check_mark: {metrics.finish()}")
     logger.info("Done!")
+
+
+if __name__ == "__main__":
+    main()
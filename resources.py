@@ -0,0 +1,40 @@
+import threading
+import metrics
+import utils
+import time
+import os
+
+CACHE_TTL = float(os.getenv('CACHE_TTL', 900))  # seconds a session, secret or webhook is reused for
+
+cache = {}  # key -> (expires_at, value)
+lock = threading.Lock()
+
+# -------------------------------------- Functions --------------------------------------
+
+# Function to return a cached value, calling fetch when it is missing or older than CACHE_TTL.
+# The lock is held while fetching so jobs starting together make a single call per key.
+def cached(key, fetch):
+    with lock:
+        hit = cache.get(key)
+        if hit is not None and hit[0] > time.monotonic():
+            metrics.count(f'{key[0]}_cache_hits')
+            return hit[1]
+        value = fetch()
+        cache[key] = (time.monotonic() + CACHE_TTL, value)
+        metrics.count(f'{key[0]}_fetches')
+        return value
+
+
+# Drop-in replacements for the utils helpers of the same name. Boto3 sessions are not thread-safe,
+# so each thread gets its own; a forked worker process inherits the session of its parent.
+# Secrets and webhooks are plain values and are shared by all jobs in the process.
+def get_session(creds):
+    return cached(('session', creds['region'], threading.get_ident()), lambda: utils.get_session(creds))
+
+
+def get_secret(name, session, region):
+    return cached(('secret', name, region), lambda: utils.get_secret(name, session, region))
+
+
+def get_webhook(session, creds):
+    return cached(('webhook', creds['region']), lambda: utils.get_webhook(session, creds))
@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+from utils import get_logger
+import importlib
+import metrics
+import time
+import sys
+import os
+
+MAX_JOBS = int(os.getenv('MAX_JOBS', 4))  # jobs run side by side
+
+# Jobs by module, with whether they fork worker processes. Forking while other jobs run threads
+# can leave a lock held in the child, so forking jobs run one at a time before the others start.
+# The remaining jobs only use threads and run concurrently.
+JOBS = {
+    'manual_transactions': True,
+    'purchase_protection_log': True,
+    'exchange_rates': False,
+    'tableau_refreshes': False
+}
+
+# -------------------------------------- Functions --------------------------------------
+
+# Function to import and run a job. Modules are only imported when their job runs, so pandas,
+# awswrangler or tableauserverclient are not loaded for jobs that were not asked for. Sessions,
+# secrets and webhooks are shared between the jobs through the cache in resources.py. A failed
+# job still writes its metrics, with the error status; finish does nothing if main finished them.
+def run_job(name):
+    logger = get_logger()
+    started = time.monotonic()
+    try:
+        importlib.import_module(name).main()
+        error = None
+    except (Exception, SystemExit) as e:
+        logger.exception(f"Job {name} failed: {e!r}")
+        error = repr(e)
+        metrics.finish('error')
+    return name, time.monotonic() - started, error
+
+
+def main(names):
+    logger = get_logger()
+    unknown = [n for n in names if n not in JOBS]
+    if unknown:
+        raise SystemExit(f"Unknown jobs: {', '.join(unknown)}. Available: {', '.join(JOBS)}")
+
+    results = [run_job(n) for n in names if JOBS[n]]
+    with ThreadPoolExecutor(MAX_JOBS) as executor:
+        results += list(executor.map(run_job, [n for n in names if not JOBS[n]]))
+
+    for name, elapsed, error in results:
+        logger.info(f"{name}: {'failed' if error else 'done'} in {elapsed:.1f}s")
+    if any(error for _, _, error in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or list(JOBS))
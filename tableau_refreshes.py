@@ -1,8 +1,72 @@
 from datetime import datetime, timezone, timedelta, time
+from concurrent.futures import ThreadPoolExecutor
 import tableauserverclient as TSC
 import pandas as pd
+import threading
+import requests
+import sqlite3
+import metrics
+import json
 import os
-from utils import get_session, get_secret, send_slack_notification, get_webhook
+from utils import send_slack_notification
+from resources import get_session, get_secret, get_webhook
+
+MAX_WORKERS = int(os.getenv('TABLEAU_MAX_WORKERS', 8))  # concurrent permission requests to Tableau
+SNAPSHOT_DB = os.getenv('TABLEAU_SNAPSHOT_DB', os.path.expanduser('~/.tableau_audit.db'))
+FULL_AUDIT = os.getenv('TABLEAU_FULL_AUDIT', '0') == '1'  # refetch everything and alert on every violation
+PERMISSIONS_MAX_AGE = float(os.getenv('TABLEAU_PERMISSIONS_MAX_AGE', 24))  # hours before unchanged permissions are refetched
+
+
+# Function to open the snapshot store holding the last audited state: the permitted groups of
+# each datasource with its updated_at and the time they were fetched, and the violations
+# reported by the last run.
+def open_snapshot():
+    db = sqlite3.connect(SNAPSHOT_DB)
+    db.execute('create table if not exists datasources (id text primary key, updated_at text, groups text, fetched_at text)')
+    db.execute('create table if not exists violations (kind text, key text, detail text, primary key (kind, key))')
+    return db
+
+
+# Function to store the current violations of a kind and return the keys that are new (or whose
+# detail changed) and the keys that were resolved since the last run
+def diff_violations(db, kind, current):
+    previous = dict(db.execute('select key, detail from violations where kind = ?', (kind,)).fetchall())
+    db.execute('delete from violations where kind = ?', (kind,))
+    db.executemany('insert into violations values (?, ?, ?)', [(kind, k, v) for k, v in current.items()])
+    db.commit()
+
+    new = [k for k, v in current.items() if FULL_AUDIT or previous.get(k) != v]
+    resolved = [k for k in previous if k not in current]
+    return new, resolved
+
+
+# Function to post the violations that resolved since the last run
+def notify_resolved(webhook_url, title, resolved):
+    if resolved:
+        notification_message = f":white_check_mark: {title}:\n\n"
+        for k in resolved:
+            notification_message += f"- {k}\n"
+        send_slack_notification(webhook_url, notification_message)
+
+
+# Requests session counting the REST calls made through it, passed to TSC.Server
+class CountingSession(requests.Session):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self.lock:
+            self.calls += 1
+        return super().request(*args, **kwargs)
+
+
+# Function to fetch the permission rules of a datasource, run in the worker pool.
+# The rules are fetched lazily, so they are read here to make the request in the worker.
+def fetch_permissions(server, ds):
+    server.datasources.populate_permissions(ds)
+    return ds.permissions
 
 
 def main():
@@ -11,21 +75,26 @@ def main():
             'cluster_id': 'wbx-data',
             'region': 'us-west-2'}
 
-    # Initializing Botocore client
-    session = get_session(creds)
+    metrics.start_run('tableau_refreshes')
 
-    tableau_secret = get_secret(os.environ['PAT_VALUE'], session, creds['region'])
-    webhook_url = get_webhook(session, creds)
+    # Initializing Botocore client
+    with metrics.span('session'):
+        session = get_session(creds)
 
-    send_slack_notification(webhook_url, 'Starting Tableau tests :loading_dots:')
+    with metrics.span('secrets'):
+        tableau_secret = get_secret(os.environ['PAT_VALUE'], session, creds['region'])
+        webhook_url = get_webhook(session, creds)
 
     PAT_NAME = tableau_secret['PAT_NAME']
     PAT_VALUE = tableau_secret['PAT_VALUE'] # replace after 1 year
     SITE_NAME = 'webconnex'
-    SERVER = 'https://us-west-2b.online.tableau.com/'
+    SERVER = os.getenv('TABLEAU_SERVER', 'https://us-west-2b.online.tableau.com/')
     
     tableau_auth = TSC.PersonalAccessTokenAuth(PAT_NAME, PAT_VALUE, site_id=SITE_NAME)
-    server = TSC.Server(SERVER, use_server_version=True)
+
+    # Count the REST calls made by the audit
+    http = CountingSession()
+    server = TSC.Server(SERVER, use_server_version=True, session_factory=lambda: http)
     
     datasources = []
     permissions_dict = {}
@@ -58,32 +127,72 @@ def main():
                 'Processing Volume in Financial Dashboards':  ['Account Manager Admin', 'Data Engineering', 'Internal', 'Payments']
                 }
 
+    db = open_snapshot()
+    snapshot = {} if FULL_AUDIT else {r[0]: (r[1], json.loads(r[2]), r[3]) for r in
+                                      db.execute('select id, updated_at, groups, fetched_at from datasources')}
+
     with server.auth.sign_in(tableau_auth):
         now = datetime.now(timezone.utc) - timedelta(hours=7)
         
-        datasources_data = [ds for ds in TSC.Pager(server.datasources) if ds.has_extracts]
-        tasks_data, _ = server.tasks.get()
+        # Index all datasources by id so the task audit does not look them up one by one
+        with metrics.span('index'):
+            datasource_index = {ds.id: ds for ds in TSC.Pager(server.datasources)}
+            datasources_data = [ds for ds in datasource_index.values() if ds.has_extracts]
+            tasks_data, _ = server.tasks.get()
         
-        for ds in datasources_data:
-            if ds.project_name in projects:
-                datasources.append([(now - (ds.updated_at or now)).days, ds.name, ds.updated_at, ds.project_name])
-                wb = ds.name + ' in ' + ds.project_name
-                permissions_dict[wb] = []
-                server.datasources.populate_permissions(ds)
-                ds_permissions = ds.permissions
-                
+        # Permissions are refetched for datasources whose updated_at changed since the last run.
+        # Permission edits do not change updated_at, so they are also refetched once the last
+        # fetch is older than PERMISSIONS_MAX_AGE.
+        audited = [ds for ds in datasources_data if ds.project_name in projects]
+        stale_before = (datetime.now(timezone.utc) - timedelta(hours=PERMISSIONS_MAX_AGE)).isoformat(timespec='seconds')
+        changed = [ds for ds in audited if ds.id not in snapshot
+                   or snapshot[ds.id][0] != str(ds.updated_at)
+                   or (snapshot[ds.id][2] or '') < stale_before]
+        print('Datasources changed since last audit: ', len(changed))
+        metrics.count('datasources', len(audited))
+        metrics.count('datasources_changed', len(changed))
+
+        # Index the group names once instead of paging through all groups for every grantee
+        with metrics.span('groups'):
+            group_names = {group_item.id: group_item.name for group_item in TSC.Pager(server.groups)} if changed else {}
+
+        with metrics.span('permissions'), ThreadPoolExecutor(MAX_WORKERS) as executor:
+            for ds, ds_permissions in zip(changed, executor.map(lambda ds: fetch_permissions(server, ds), changed)):
+                groups = []
                 for rule in ds_permissions:
                     group_user_type = rule.grantee.tag_name
                     group_user_id = rule.grantee.id
-                    if group_user_type == 'group':
-                        for group_item in TSC.Pager(server.groups):
-                            if group_item.id == group_user_id:
-                                group_user_name = group_item.name
-                                permissions_dict[wb].append(group_user_name)
-                                break
+                    if group_user_type == 'group' and group_user_id in group_names:
+                        groups.append(group_names[group_user_id])
+                snapshot[ds.id] = (str(ds.updated_at), groups, datetime.now(timezone.utc).isoformat(timespec='seconds'))
+
+        db.executemany('insert or replace into datasources (id, updated_at, groups, fetched_at) values (?, ?, ?, ?)',
+                       [(ds.id, snapshot[ds.id][0], json.dumps(snapshot[ds.id][1]), snapshot[ds.id][2]) for ds in audited])
+        db.commit()
+
+        for ds in audited:
+            datasources.append([(now - (ds.updated_at or now)).days, ds.name, ds.updated_at, ds.project_name])
+            wb = ds.name + ' in ' + ds.project_name
+            permissions_dict[wb] = snapshot[ds.id][1]
+
+        # Resolve the task targets from the indexes. Workbooks are only paged in if a task targets
+        # one, and targets missing from the indexes are fetched together in the worker pool.
+        indexes = {'datasource': datasource_index, 'workbook': {}}
+        endpoints = {'datasource': server.datasources, 'workbook': server.workbooks}
+        with metrics.span('targets'):
+            if any(task.target.type == 'workbook' for task in tasks_data):
+                indexes['workbook'] = {wb.id: wb for wb in TSC.Pager(server.workbooks)}
+
+            misses = list({(task.target.type, task.target.id) for task in tasks_data
+                           if task.target.id not in indexes[task.target.type]})
+            with ThreadPoolExecutor(MAX_WORKERS) as executor:
+                for (target_type, target_id), item in zip(misses, executor.map(lambda m: endpoints[m[0]].get_by_id(m[1]), misses)):
+                    indexes[target_type][target_id] = item
+        metrics.count('tasks', len(tasks_data))
+        metrics.count('target_misses', len(misses))
 
         for task in tasks_data:
-            datasource = server.datasources.get_by_id(task.target.id)
+            datasource = indexes[task.target.type][task.target.id]
             interval = task.schedule_item.interval_item
             project_name = datasource.project_name
 
@@ -98,6 +207,9 @@ def main():
 
                 tasks.append(task_info)
 
+    print('Tableau API calls: ', http.calls)
+    metrics.count('api_calls', http.calls)
+
     # Get the extracts that have not been refreshed
     df_datasources = pd.DataFrame(datasources)
     df_datasources.columns = ['days_since_refresh', 'extract', 'updated_at', 'project']
@@ -105,37 +217,49 @@ def main():
     not_refreshed = df_datasources[df_datasources['days_since_refresh'] > 0].sort_values(by = 'days_since_refresh', ascending = False).reset_index(drop = True)
     print('Extracts not refreshed: ', len(not_refreshed))
 
-    if len(not_refreshed) > 0:
+    # Only extracts that went stale since the last run are reported
+    current = {f"{x[0]} in {x[1]}": str(x[2]) for x in not_refreshed[['extract', 'project', 'updated_at']].values}
+    new, resolved = diff_violations(db, 'not_refreshed', current)
+    changes = len(new) + len(resolved)  # violations reported or resolved by this run
+
+    if len(new) > 0:
         notification_message = ":warning: Tableau extracts last refresh:\n\n"
-        for x in not_refreshed[['extract', 'project', 'updated_at']].values:
-            notification_message += f"- {x[2]}    :    {x[0]} in {x[1]}\n"
+        for k in new:
+            notification_message += f"- {current[k]}    :    {k}\n"
 
         send_slack_notification(webhook_url, notification_message)
-
-    send_slack_notification(webhook_url, 'Extract freshness test finished :white_check_mark:')
+    notify_resolved(webhook_url, 'Tableau extracts refreshed again', resolved)
     # ------------------------------------------------------------------------------------
 
     # Get the missing permissions for each extract
-    missing_permissions = []
+    missing_permissions = {}
+    missing_extracts = {}
 
     for k in permissions.keys():
         try:
             diff = set(permissions[k]).difference(set(permissions_dict[k]))
             if diff:
-                missing_permissions.append(k + '    :    ' + ', '.join(diff))
+                missing_permissions[k] = ', '.join(sorted(diff))
         except:
-            send_slack_notification(webhook_url, f":red-x-mark: {k} doesn't exist.")
+            missing_extracts[k] = ''
     
     print('Extracts missing permissions: ', len(missing_permissions))
 
-    if len(missing_permissions) > 0:
+    new, resolved = diff_violations(db, 'missing_extract', missing_extracts)
+    changes += len(new) + len(resolved)
+    for k in new:
+        send_slack_notification(webhook_url, f":red-x-mark: {k} doesn't exist.")
+    notify_resolved(webhook_url, 'Tableau extracts found again', resolved)
+
+    new, resolved = diff_violations(db, 'missing_permissions', missing_permissions)
+    changes += len(new) + len(resolved)
+    if len(new) > 0:
         notification_message = ":warning: Tableau extracts missing permissions:\n\n"
-        for x in missing_permissions:
-            notification_message += f"- {x}\n"
+        for k in new:
+            notification_message += f"- {k}    :    {missing_permissions[k]}\n"
 
         send_slack_notification(webhook_url, notification_message)
-
-    send_slack_notification(webhook_url, 'Extract permissions test finished :white_check_mark:')
+    notify_resolved(webhook_url, 'Tableau extract permissions fixed', resolved)
     # ------------------------------------------------------------------------------------
     
     # Get task schedules outside of 2-3 am window
@@ -143,14 +267,24 @@ def main():
     df_tasks.sort_values(by='Datasource Name', inplace=True, key=lambda col: col.str.lower())
     wrong_schedules = df_tasks[df_tasks['In Range'] == False]
 
-    if len(wrong_schedules) > 0:
+    current = {f"{x[0]} in {x[1]}": str(x[3]) for x in wrong_schedules.values}
+    new, resolved = diff_violations(db, 'wrong_schedule', current)
+    changes += len(new) + len(resolved)
+
+    if len(new) > 0:
         notification_message = ":warning: Please schedule tasks between 2 and 3 am:\n\n"
-        for x in wrong_schedules.values:
-            notification_message += f"- {x[0]} in {x[1]} (currently at {x[3]})\n"
+        for k in new:
+            notification_message += f"- {k} (currently at {current[k]})\n"
 
         send_slack_notification(webhook_url, notification_message)
+    notify_resolved(webhook_url, 'Task schedules back between 2 and 3 am', resolved)
+
+    db.close()
 
-    send_slack_notification(webhook_url, 'Tasks schedules test finished :white_check_mark:')
+    # Runs with nothing new to report stay silent, so the audit can run hourly
+    summary = metrics.finish()
+    if changes:
+        send_slack_notification(webhook_url, f'Tableau tests finished :white_check_mark: {summary}')
             
 if __name__ == '__main__':
     main()